@@ -1,7 +1,7 @@
 from flask import Flask, request, jsonify, make_response
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from bson import ObjectId
 from datetime import datetime, timedelta
 import json
@@ -10,7 +10,12 @@ import redis
 from functools import wraps
 import os
 import urllib.parse
+import threading
+import itertools
+import time
+from collections import OrderedDict
 from websocket import register_websocket_handlers # 导入WebSocket处理函数
+from unread_counters import UnreadCounters
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -24,6 +29,24 @@ CORS(app, origins=["http://localhost:3000"])
 JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
 SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
 
+# 成员列表分页
+MEMBER_PAGE_SIZE = int(os.getenv('MEMBER_PAGE_SIZE', 200))  # 默认每页成员数
+MEMBER_PAGE_MAX = 500  # 单页最多成员数
+
+# 用户资料缓存
+USER_PROFILE_CACHE_SIZE = int(os.getenv('USER_PROFILE_CACHE_SIZE', 5000))  # 每个进程缓存的用户数
+USER_PROFILE_CACHE_TTL = int(os.getenv('USER_PROFILE_CACHE_TTL', 300))  # 缓存有效期（秒）
+USER_PROFILE_INVALIDATE_CHANNEL = 'chat:user_profiles:invalidate'  # 跨进程失效通知频道
+USER_PROFILE_PROJECTION = {'email': 1, 'nickname': 1, 'role': 1}
+INTERNAL_API_KEY = os.getenv('INTERNAL_API_KEY')
+
+# 消息分页：按时间倒序，时间相同时按_id倒序
+MESSAGE_SORT = [('timestamp', -1), ('_id', -1)]
+MESSAGE_PAGE_MAX = 200  # 单页最多消息数
+
+# 未读计数对账间隔（秒）
+UNREAD_RECONCILE_INTERVAL = int(os.getenv('UNREAD_RECONCILE_INTERVAL', 600))
+
 # 初始化SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*")
 
@@ -80,56 +103,312 @@ def get_current_user():
         'nickname': '大师'
     }
 
+class UserProfileCache:
+    """进程内用户资料LRU缓存（带TTL），未命中的用户通过一次 $in 查询批量加载"""
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # user_id -> (过期时间, 资料)
+    
+    def get_many(self, user_ids):
+        """批量获取用户资料，返回 {user_id: 资料}，不存在的用户资料为空字典"""
+        user_ids = {user_id for user_id in user_ids if user_id is not None}
+        now = time.monotonic()
+        profiles = {}
+        missing = []
+        
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry and entry[0] > now:
+                    self.entries.move_to_end(user_id)
+                    profiles[user_id] = entry[1]
+                else:
+                    missing.append(user_id)
+        
+        if missing:
+            found = {
+                user['_id']: user
+                for user in db.users.find({'_id': {'$in': missing}}, USER_PROFILE_PROJECTION)
+            }
+            with self.lock:
+                for user_id in missing:
+                    profile = found.get(user_id) or {}
+                    self.entries[user_id] = (now + self.ttl, profile)
+                    self.entries.move_to_end(user_id)
+                    profiles[user_id] = profile
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        
+        return profiles
+    
+    def get(self, user_id):
+        """获取单个用户资料"""
+        return self.get_many([user_id]).get(user_id, {})
+    
+    def invalidate(self, user_ids=None):
+        """使指定用户（或全部）的缓存失效"""
+        with self.lock:
+            if user_ids is None:
+                self.entries.clear()
+            else:
+                for user_id in user_ids:
+                    self.entries.pop(user_id, None)
+
+user_profiles = UserProfileCache(USER_PROFILE_CACHE_SIZE, USER_PROFILE_CACHE_TTL)
+
+def invalidate_user_profiles(user_ids=None):
+    """通知所有进程使用户资料缓存失效（角色或昵称变更后调用）"""
+    if redis_client:
+        try:
+            redis_client.publish(USER_PROFILE_INVALIDATE_CHANNEL, json.dumps(user_ids))
+            return
+        except Exception as e:
+            logger.warning(f"发布用户缓存失效通知失败，仅清理本进程: {str(e)}")
+    user_profiles.invalidate(user_ids)
+
+def listen_user_profile_invalidations():
+    """订阅用户资料失效通知，断线后清空本地缓存并重连"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(USER_PROFILE_INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    user_profiles.invalidate(json.loads(message['data']))
+        except Exception as e:
+            logger.error(f"用户缓存失效订阅中断，5秒后重连: {str(e)}")
+            user_profiles.invalidate()
+            time.sleep(5)
+
+if redis_client:
+    threading.Thread(target=listen_user_profile_invalidations, daemon=True).start()
+
+# 已读状态：chat_read_state 集合中每个 (user_id, chat_id) 一条记录，last_read_at 之前的消息视为已读
+def get_read_watermarks(user_id, chat_ids):
+    """批量获取用户在各聊天中的已读时间，返回 {chat_id: last_read_at}"""
+    return {
+        state['chat_id']: state['last_read_at']
+        for state in db.chat_read_state.find(
+            {'user_id': user_id, 'chat_id': {'$in': list(chat_ids)}},
+            {'chat_id': 1, 'last_read_at': 1}
+        )
+    }
+
+def unread_query(user_id, chat_id, watermark):
+    """未读消息查询条件：已读时间之后他人发送的消息（使用 chat_id+timestamp 索引）"""
+    query = {'chat_id': chat_id, 'sender_id': {'$ne': user_id}, 'deleted': {'$ne': True}}
+    if watermark:
+        query['timestamp'] = {'$gt': watermark}
+    return query
+
+def count_unread_from_db(user_id, chat_ids):
+    """从Mongo批量统计未读数，每个聊天只扫描已读时间之后的索引范围"""
+    chat_ids = list(chat_ids)
+    watermarks = get_read_watermarks(user_id, chat_ids)
+    counts = {chat_id: 0 for chat_id in chat_ids}
+    for count in db.messages.aggregate([
+        {'$match': {'$or': [
+            unread_query(user_id, chat_id, watermarks.get(chat_id)) for chat_id in chat_ids
+        ]}},
+        {'$group': {'_id': '$chat_id', 'unread_count': {'$sum': 1}}}
+    ]):
+        counts[count['_id']] = count['unread_count']
+    return counts
+
+# Redis中的 (用户, 聊天) 未读计数，REST接口与WebSocket共用
+unread_counters = UnreadCounters(redis_client, count_unread_from_db, logger)
+
+def count_unread(user_id, chat_id):
+    """获取用户在聊天中的未读消息数"""
+    return unread_counters.get(user_id, chat_id)
+
+def mark_chat_read(user_id, chat_id, read_at=None):
+    """将用户在聊天中的已读时间推进到read_at（默认当前时间），不会回退，并清零未读计数"""
+    now = datetime.utcnow()
+    db.chat_read_state.update_one(
+        {'user_id': user_id, 'chat_id': chat_id},
+        {'$max': {'last_read_at': read_at or now}, '$set': {'updated_at': now}},
+        upsert=True
+    )
+    unread_counters.reset(user_id, chat_id)
+
+def is_message_read(msg, user_id, watermark):
+    """消息对用户是否已读：自己发送的，或不晚于已读时间"""
+    return msg['sender_id'] == user_id or (watermark is not None and msg['timestamp'] <= watermark)
+
+# 消息总数：chat_counters 集合中每个聊天一条计数，首次读取时从messages初始化，
+# 初始化与并发发送之间的偏差由定时对账（reconcile_message_totals）修正
+def get_message_total(chat_id):
+    """获取聊天的消息总数"""
+    counter = db.chat_counters.find_one({'_id': chat_id}, {'message_count': 1})
+    if counter:
+        return counter['message_count']
+    
+    total = db.messages.count_documents({'chat_id': chat_id, 'deleted': {'$ne': True}})
+    db.chat_counters.update_one({'_id': chat_id}, {'$setOnInsert': {'message_count': total}}, upsert=True)
+    return total
+
+def record_new_message(chat_id, sender_id):
+    """新消息：消息总数加一（计数已初始化时），其他读者未读数加一"""
+    db.chat_counters.update_one({'_id': chat_id}, {'$inc': {'message_count': 1}})
+    unread_counters.increment(chat_id, sender_id)
+
+def reconcile_message_totals(batch_size=500):
+    """与messages对账消息总数，返回修正的聊天数
+    
+    每批聊天一次聚合统计；只在计数自读取后未变化时写回，避免覆盖对账期间的新增。
+    """
+    corrected = 0
+    counters = db.chat_counters.find({}, {'message_count': 1}).batch_size(batch_size)
+    while True:
+        batch = {counter['_id']: counter['message_count'] for counter in itertools.islice(counters, batch_size)}
+        if not batch:
+            break
+        
+        actual = {chat_id: 0 for chat_id in batch}
+        for count in db.messages.aggregate([
+            {'$match': {'chat_id': {'$in': list(batch)}, 'deleted': {'$ne': True}}},
+            {'$group': {'_id': '$chat_id', 'message_count': {'$sum': 1}}}
+        ]):
+            actual[count['_id']] = count['message_count']
+        
+        operations = [
+            UpdateOne({'_id': chat_id, 'message_count': cached}, {'$set': {'message_count': actual[chat_id]}})
+            for chat_id, cached in batch.items() if actual[chat_id] != cached
+        ]
+        if operations:
+            corrected += db.chat_counters.bulk_write(operations, ordered=False).modified_count
+    
+    if corrected:
+        logger.info(f"消息总数对账完成，修正 {corrected} 个聊天")
+    return corrected
+
+def reset_chat_counters(chat_id):
+    """聊天消息被删除后清理计数"""
+    db.chat_counters.delete_one({'_id': chat_id})
+    unread_counters.clear_chat(chat_id)
+
+def message_page_query(chat_id, before=None):
+    """消息分页查询条件，before为消息ID或ISO时间时只返回更早的消息
+    
+    游标定位走 (chat_id, timestamp, _id) 索引，翻到多深耗时都相同。
+    """
+    query = {'chat_id': chat_id, 'deleted': {'$ne': True}}
+    if not before:
+        return query
+    
+    if ObjectId.is_valid(before):
+        anchor = db.messages.find_one({'_id': ObjectId(before), 'chat_id': chat_id}, {'timestamp': 1})
+        if not anchor:
+            raise ValueError('分页游标对应的消息不存在')
+        query['$or'] = [
+            {'timestamp': {'$lt': anchor['timestamp']}},
+            {'timestamp': anchor['timestamp'], '_id': {'$lt': anchor['_id']}}
+        ]
+    else:
+        query['timestamp'] = {'$lt': datetime.fromisoformat(before)}
+    return query
+
+def fetch_message_page(chat_id, limit, offset=0, before=None):
+    """获取一页消息（按时间倒序），返回 (消息列表, 是否还有更早的消息)"""
+    cursor = db.messages.find(message_page_query(chat_id, before)).sort(MESSAGE_SORT)
+    if not before and offset:
+        cursor = cursor.skip(offset)
+    
+    # 多取一条用于判断是否还有更早的消息
+    page = list(cursor.limit(limit + 1))
+    return page[:limit], len(page) > limit
+
 # 健康检查
 @app.route('/health')
 def health():
     return jsonify({'status': 'healthy'})
 
 # 注册WebSocket处理程序
-register_websocket_handlers(socketio, db, redis_client, logger)
+register_websocket_handlers(socketio, db, redis_client, logger, record_new_message, mark_chat_read)
 
 # 获取聊天成员列表
 @app.route('/api/chat/members')
 @verify_token(['Master', 'Firstmate'])
 def get_chat_members():
-    """获取聊天成员列表"""
+    """获取聊天成员列表（分页，分页信息在响应头 X-Total-Count / X-Next-Offset 中）
+    
+    每页固定次数的查询（成员、私聊设置、已读时间、最新消息、未读数），与成员数量无关。
+    """
     try:
         current_user = get_current_user()
+        limit = min(int(request.args.get('limit', MEMBER_PAGE_SIZE)), MEMBER_PAGE_MAX)
+        offset = int(request.args.get('offset', 0))
         
-        # 查询所有Member用户
-        members = db.users.find({'role': 'Member'})
+        # 查询当前页的Member用户
+        members = list(db.users.find(
+            {'role': 'Member'},
+            {'email': 1, 'nickname': 1}
+        ).sort('_id', 1).skip(offset).limit(limit))
+        member_ids = [str(member['_id']) for member in members]
+        
+        # 批量获取私聊信息
+        private_chats = {
+            chat['member_id']: chat
+            for chat in db.private_chats.find({'member_id': {'$in': member_ids}})
+        }
+        
+        # 批量获取已开启私聊的已读时间、最新消息和未读数量
+        enabled_chat_ids = [
+            f'private_{member_id}' for member_id, chat in private_chats.items() if chat.get('enabled')
+        ]
+        watermarks = {}
+        chat_summaries = {}
+        unread_counts = {}
+        if enabled_chat_ids:
+            # 整页未读数一次MGET
+            unread_counts = unread_counters.get_many(current_user['id'], enabled_chat_ids)
+            watermarks = get_read_watermarks(current_user['id'], enabled_chat_ids)
+            # 每个聊天只取最新一条消息：子管道按 (chat_id, timestamp, _id) 索引倒序读取1条
+            chat_summaries = {
+                chat['chat_id']: chat['last_message'][0]
+                for chat in db.private_chats.aggregate([
+                    {'$match': {'member_id': {'$in': [chat_id[len('private_'):] for chat_id in enabled_chat_ids]}}},
+                    {'$project': {'_id': 0, 'chat_id': {'$concat': ['private_', '$member_id']}}},
+                    {'$lookup': {
+                        'from': 'messages',
+                        'let': {'chat_id': '$chat_id'},
+                        'pipeline': [
+                            {'$match': {'$expr': {'$eq': ['$chat_id', '$$chat_id']}, 'deleted': {'$ne': True}}},
+                            {'$sort': {'timestamp': -1}},
+                            {'$limit': 1},
+                            {'$project': {'_id': 0, 'content': 1, 'timestamp': 1, 'sender_id': 1}}
+                        ],
+                        'as': 'last_message'
+                    }}
+                ])
+                if chat['last_message']
+            }
         
         member_list = []
         for member in members:
-            # 获取私聊信息
-            private_chat = db.private_chats.find_one({'member_id': str(member['_id'])})
+            member_id = str(member['_id'])
+            private_chat = private_chats.get(member_id)
             
             # 获取最新消息
             last_message = None
             unread_count = 0
-            if private_chat and private_chat.get('enabled'):
-                last_msg = db.messages.find_one(
-                    {'chat_id': f'private_{member["_id"]}', 'deleted': {'$ne': True}},
-                    sort=[('timestamp', -1)]
-                )
-                if last_msg:
-                    last_message = {
-                        'content': last_msg['content'],
-                        'timestamp': last_msg['timestamp'],
-                        'sender_id': last_msg['sender_id'],
-                        'read_status': current_user['id'] in last_msg.get('read_by', [])
-                    }
-                
-                # 计算未读消息数量
-                unread_count = db.messages.count_documents({
-                    'chat_id': f'private_{member["_id"]}',
-                    'sender_id': {'$ne': current_user['id']},
-                    'read_by': {'$ne': current_user['id']},
-                    'deleted': {'$ne': True}
-                })
+            chat_id = f'private_{member_id}'
+            summary = chat_summaries.get(chat_id) if private_chat and private_chat.get('enabled') else None
+            if summary:
+                last_message = {
+                    'content': summary['content'],
+                    'timestamp': summary['timestamp'],
+                    'sender_id': summary['sender_id'],
+                    'read_status': is_message_read(summary, current_user['id'], watermarks.get(chat_id))
+                }
+                unread_count = unread_counts.get(chat_id, 0)
             
             member_info = {
-                'id': str(member['_id']),
+                'id': member_id,
                 'email': member['email'],
                 'nickname': member.get('nickname'),
                 'privateChatEnabled': private_chat.get('enabled', False) if private_chat else False,
@@ -141,7 +420,16 @@ def get_chat_members():
             
             member_list.append(member_info)
         
-        return jsonify(member_list)
+        # 保持响应体为成员数组，分页信息放在响应头中
+        response = jsonify(member_list)
+        if offset == 0 and len(members) < limit:
+            total = len(members)
+        else:
+            total = db.users.count_documents({'role': 'Member'})
+        response.headers['X-Total-Count'] = str(total)
+        if offset + len(members) < total:
+            response.headers['X-Next-Offset'] = str(offset + len(members))
+        return response
         
     except Exception as e:
         logger.error(f"获取成员列表失败: {str(e)}")
@@ -166,7 +454,7 @@ def get_group_chat_info():
         
         last_message_info = None
         if last_message:
-            sender_info = db.users.find_one({'_id': last_message['sender_id']}) or {}
+            sender_info = user_profiles.get(last_message['sender_id'])
             last_message_info = {
                 'content': last_message['content'],
                 'timestamp': last_message['timestamp'],
@@ -175,12 +463,7 @@ def get_group_chat_info():
             }
         
         # 计算未读消息数量
-        unread_count = db.messages.count_documents({
-            'chat_id': 'general',
-            'sender_id': {'$ne': current_user['id']},
-            'read_by': {'$ne': current_user['id']},
-            'deleted': {'$ne': True}
-        })
+        unread_count = count_unread(current_user['id'], 'general')
         
         group_info = {
             'id': 'general',
@@ -206,22 +489,26 @@ def get_aggregated_messages():
     """获取聚合群聊消息（增强版，包含已读状态）"""
     try:
         current_user = get_current_user()
-        limit = int(request.args.get('limit', 50))
+        limit = min(int(request.args.get('limit', 50)), MESSAGE_PAGE_MAX)
         offset = int(request.args.get('offset', 0))
+        before = request.args.get('before')
+        requested_at = datetime.utcnow()
+        watermark = get_read_watermarks(current_user['id'], ['general']).get('general')
         
-        # 获取群聊消息
-        messages_cursor = db.messages.find({
-            'chat_id': 'general',
-            'deleted': {'$ne': True}
-        }).sort('timestamp', -1).skip(offset).limit(limit)
+        # 获取群聊消息（传入before时按游标翻页）
+        try:
+            page, has_more = fetch_message_page('general', limit, offset, before)
+        except ValueError:
+            return jsonify({'error': '无效的分页游标'}), 400
+        
+        # 批量获取发送者信息
+        senders = user_profiles.get_many(msg['sender_id'] for msg in page)
         
         messages = []
-        for msg in messages_cursor:
+        for msg in page:
             # 检查消息是否被当前用户读过
-            read_status = current_user['id'] in msg.get('read_by', [])
-            
-            # 获取发送者信息
-            sender_info = db.users.find_one({'_id': msg['sender_id']}) or {}
+            read_status = is_message_read(msg, current_user['id'], watermark)
+            sender_info = senders.get(msg['sender_id'], {})
             
             message_data = {
                 'id': str(msg['_id']),
@@ -241,24 +528,15 @@ def get_aggregated_messages():
         # 反转消息顺序（最新的在底部）
         messages.reverse()
         
-        # 自动标记所有member消息为已读（仅对Master/Firstmate）
+        # 自动标记群聊为已读（仅对Master/Firstmate）
         if current_user['role'] in ['Master', 'Firstmate']:
-            db.messages.update_many(
-                {
-                    'chat_id': 'general',
-                    'sender_role': 'Member',
-                    'read_by': {'$ne': current_user['id']},
-                    'deleted': {'$ne': True}
-                },
-                {
-                    '$addToSet': {'read_by': current_user['id']},
-                    '$set': {'updated_at': datetime.utcnow()}
-                }
-            )
+            mark_chat_read(current_user['id'], 'general', requested_at)
         
         return jsonify({
             'messages': messages,
-            'total': db.messages.count_documents({'chat_id': 'general', 'deleted': {'$ne': True}})
+            'has_more': has_more,
+            'next_before': str(page[-1]['_id']) if has_more else None,
+            'total': get_message_total('general')
         })
         
     except Exception as e:
@@ -286,22 +564,36 @@ def get_private_messages(member_id):
             return jsonify({'error': '私聊已过期'}), 403
         
         chat_id = f'private_{member_id}'
-        limit = int(request.args.get('limit', 50))
+        limit = min(int(request.args.get('limit', 50)), MESSAGE_PAGE_MAX)
         offset = int(request.args.get('offset', 0))
+        before = request.args.get('before')
         
-        # 获取消息
-        messages_cursor = db.messages.find({
-            'chat_id': chat_id,
-            'deleted': {'$ne': True}
-        }).sort('timestamp', -1).skip(offset).limit(limit)
+        # 私聊参与者很少，一次取出所有人的已读时间
+        read_states = list(db.chat_read_state.find({'chat_id': chat_id}, {'user_id': 1, 'last_read_at': 1}))
+        watermark = next(
+            (state['last_read_at'] for state in read_states if state['user_id'] == current_user['id']), None
+        )
+        
+        # 获取消息（传入before时按游标翻页）
+        try:
+            page, has_more = fetch_message_page(chat_id, limit, offset, before)
+        except ValueError:
+            return jsonify({'error': '无效的分页游标'}), 400
+        
+        # 批量获取发送者信息
+        senders = user_profiles.get_many(msg['sender_id'] for msg in page)
         
         messages = []
-        for msg in messages_cursor:
+        for msg in page:
             # 检查消息是否被当前用户读过
-            read_status = current_user['id'] in msg.get('read_by', [])
+            read_status = is_message_read(msg, current_user['id'], watermark)
+            sender_info = senders.get(msg['sender_id'], {})
             
-            # 获取发送者信息
-            sender_info = db.users.find_one({'_id': msg['sender_id']}) or {}
+            # 已读人数：发送者本人加上已读时间不早于该消息的其他参与者
+            read_by_count = 1 + sum(
+                1 for state in read_states
+                if state['user_id'] != msg['sender_id'] and state['last_read_at'] >= msg['timestamp']
+            )
             
             message_data = {
                 'id': str(msg['_id']),
@@ -313,7 +605,7 @@ def get_private_messages(member_id):
                 'type': msg.get('type', 'text'),
                 'timestamp': msg['timestamp'].isoformat(),
                 'read_status': read_status,
-                'read_by_count': len(msg.get('read_by', [])),
+                'read_by_count': read_by_count,
                 'attachments': msg.get('attachments', [])
             }
             messages.append(message_data)
@@ -326,19 +618,16 @@ def get_private_messages(member_id):
         if messages:
             latest_message = messages[-1]
         
-        unread_count = db.messages.count_documents({
-            'chat_id': chat_id,
-            'sender_id': {'$ne': current_user['id']},
-            'read_by': {'$ne': current_user['id']},
-            'deleted': {'$ne': True}
-        })
+        unread_count = count_unread(current_user['id'], chat_id)
         
         return jsonify({
             'messages': messages,
             'lastMessage': latest_message,
             'unreadCount': unread_count,
             'expiresAt': private_chat.get('expires_at').isoformat() if private_chat.get('expires_at') else None,
-            'total': db.messages.count_documents({'chat_id': chat_id, 'deleted': {'$ne': True}})
+            'has_more': has_more,
+            'next_before': str(page[-1]['_id']) if has_more else None,
+            'total': get_message_total(chat_id)
         })
         
     except Exception as e:
@@ -377,7 +666,7 @@ def send_message():
                 return jsonify({'error': '私聊已过期'}), 403
         
         # 获取发送者信息
-        sender_info = db.users.find_one({'_id': current_user['id']}) or {}
+        sender_info = user_profiles.get(current_user['id'])
         
         # 创建消息
         message = {
@@ -388,7 +677,6 @@ def send_message():
             'content': content,
             'type': message_type,
             'timestamp': datetime.utcnow(),
-            'read_by': [current_user['id']],  # 发送者自动标记为已读
             'attachments': data.get('attachments', []),
             'deleted': False,
             'created_at': datetime.utcnow(),
@@ -399,6 +687,9 @@ def send_message():
         result = db.messages.insert_one(message)
         message['_id'] = result.inserted_id
         
+        # 更新消息总数和其他读者的未读数（自己发送的消息本身即视为已读）
+        record_new_message(chat_id, current_user['id'])
+        
         # 更新Redis缓存
         if redis_client:
             redis_key = f'chat:{chat_id}:latest'
@@ -488,23 +779,14 @@ def mark_group_messages_read():
         chat_id = data.get('chatId', 'general')
         current_user = get_current_user()
         
-        # 更新群聊中所有member消息的已读状态
-        result = db.messages.update_many(
-            {
-                'chat_id': chat_id,
-                'sender_role': 'Member',
-                'read_by': {'$ne': current_user['id']},
-                'deleted': {'$ne': True}
-            },
-            {
-                '$addToSet': {'read_by': current_user['id']},
-                '$set': {'updated_at': datetime.utcnow()}
-            }
-        )
+        # 推进群聊已读时间
+        read_at = datetime.utcnow()
+        marked_count = count_unread(current_user['id'], chat_id)
+        mark_chat_read(current_user['id'], chat_id, read_at)
         
         return jsonify({
             'success': True,
-            'marked_count': result.modified_count
+            'marked_count': marked_count
         })
         
     except Exception as e:
@@ -524,23 +806,14 @@ def mark_chat_as_read():
         if not chat_id:
             return jsonify({'error': '缺少chatId参数'}), 400
         
-        # 更新消息已读状态
-        result = db.messages.update_many(
-            {
-                'chat_id': chat_id,
-                'sender_id': {'$ne': current_user['id']},
-                'read_by': {'$ne': current_user['id']},
-                'deleted': {'$ne': True}
-            },
-            {
-                '$addToSet': {'read_by': current_user['id']},
-                '$set': {'updated_at': datetime.utcnow()}
-            }
-        )
+        # 推进已读时间
+        read_at = datetime.utcnow()
+        marked_count = count_unread(current_user['id'], chat_id)
+        mark_chat_read(current_user['id'], chat_id, read_at)
         
         return jsonify({
             'success': True,
-            'marked_count': result.modified_count
+            'marked_count': marked_count
         })
         
     except Exception as e:
@@ -573,6 +846,7 @@ def delete_private_chat():
             redis_client.delete(f'chat:{chat_id}:members')
             redis_client.delete(f'chat:{chat_id}:unread')
             redis_client.delete(f'chat:{chat_id}:latest')
+        reset_chat_counters(chat_id)
         
         return jsonify({'success': True})
         
@@ -605,6 +879,7 @@ def cleanup_expired_chats():
                 # 清理Redis缓存
                 if redis_client:
                     redis_client.delete(f'chat:{chat_id}:*')
+                reset_chat_counters(chat_id)
                 
                 return jsonify({'success': True, 'cleaned': True})
             else:
@@ -630,6 +905,7 @@ def cleanup_expired_chats():
                     {'chat_id': chat_id},
                     {'$set': {'deleted': True, 'updated_at': current_time}}
                 )
+                reset_chat_counters(chat_id)
                 
                 cleaned_count += 1
                 logger.info(f"清理过期私聊: {member_id}")
@@ -658,12 +934,7 @@ def get_unread_count(member_id):
         chat_id = f'private_{member_id}'
         
         # 统计未读消息数量
-        unread_count = db.messages.count_documents({
-            'chat_id': chat_id,
-            'sender_id': {'$ne': current_user['id']},  # 不是自己发送的消息
-            'read_by': {'$ne': current_user['id']},     # 自己未读的消息
-            'deleted': {'$ne': True}
-        })
+        unread_count = count_unread(current_user['id'], chat_id)
         
         return jsonify({
             'unread_count': unread_count,
@@ -680,13 +951,14 @@ def download_chat_history(member_id):
     """下载聊天记录"""
     try:
         # 获取所有私聊消息
-        messages = db.messages.find({
+        messages = list(db.messages.find({
             'chat_id': f'private_{member_id}',
             'deleted': {'$ne': True}
-        }).sort('timestamp', 1)
+        }, {'sender_id': 1, 'timestamp': 1, 'content': 1, 'type': 1}).sort('timestamp', 1))
         
-        # 获取成员信息
-        member = db.users.find_one({'_id': member_id})
+        # 一次性获取成员及所有发送者信息
+        senders = user_profiles.get_many([member_id] + [msg['sender_id'] for msg in messages])
+        member = senders.get(member_id)
         member_name = member.get('nickname', member.get('email', 'Unknown')) if member else 'Unknown'
         
         # 构建聊天记录
@@ -698,7 +970,7 @@ def download_chat_history(member_id):
         }
         
         for msg in messages:
-            sender_info = db.users.find_one({'_id': msg['sender_id']}) or {}
+            sender_info = senders.get(msg['sender_id'], {})
             chat_history['messages'].append({
                 'timestamp': msg['timestamp'].isoformat(),
                 'sender_name': sender_info.get('nickname', sender_info.get('email', 'Unknown')),
@@ -718,6 +990,21 @@ def download_chat_history(member_id):
         logger.error(f"下载聊天记录失败: {str(e)}")
         return jsonify({'error': '下载失败'}), 500
 
+# 用户资料变更通知（内部调用）
+@app.route('/api/internal/users/invalidate', methods=['POST'])
+def invalidate_user_profile_cache():
+    """用户角色或昵称变更后，使聊天服务中的用户资料缓存失效"""
+    if not INTERNAL_API_KEY or request.headers.get('X-Internal-Key') != INTERNAL_API_KEY:
+        return jsonify({'error': '无权限访问'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('user_ids')
+    if user_ids is not None and not isinstance(user_ids, list):
+        return jsonify({'error': 'user_ids必须是数组'}), 400
+    
+    invalidate_user_profiles(user_ids)
+    return jsonify({'success': True})
+
 # WebSocket事件处理
 @socketio.on('connect')
 def handle_connect():
@@ -741,7 +1028,49 @@ def handle_leave_room(data):
         leave_room(room)
         logger.info(f'用户离开房间: {room}')
 
+def ensure_indexes():
+    """创建查询所需的索引"""
+    try:
+        db.users.create_index([('role', 1), ('_id', 1)], name='role_id')
+        db.private_chats.create_index([('member_id', 1)], name='member_id')
+        db.messages.create_index([('chat_id', 1), ('timestamp', 1), ('_id', 1)], name='chat_timestamp_id')
+        db.chat_read_state.create_index([('user_id', 1), ('chat_id', 1)], name='user_chat', unique=True)
+        db.chat_read_state.create_index([('chat_id', 1), ('user_id', 1)], name='chat_user')
+        logger.info("聊天服务索引已就绪")
+    except Exception as e:
+        logger.error(f"创建索引失败: {str(e)}")
+
+def migrate_read_by_to_watermarks():
+    """将旧消息上的 read_by 数组迁移为已读时间（仅在 chat_read_state 为空时执行一次）"""
+    try:
+        if db.chat_read_state.estimated_document_count() > 0:
+            return
+        
+        # 每个 (用户, 聊天) 取其已读消息中最新的时间
+        db.messages.aggregate([
+            {'$match': {'read_by.0': {'$exists': True}}},
+            {'$unwind': '$read_by'},
+            {'$group': {
+                '_id': {'user_id': '$read_by', 'chat_id': '$chat_id'},
+                'last_read_at': {'$max': '$timestamp'}
+            }},
+            {'$project': {
+                '_id': 0,
+                'user_id': '$_id.user_id',
+                'chat_id': '$_id.chat_id',
+                'last_read_at': 1,
+                'updated_at': '$$NOW'
+            }},
+            {'$merge': {'into': 'chat_read_state', 'on': ['user_id', 'chat_id'], 'whenMatched': 'keepExisting'}}
+        ])
+        logger.info("read_by 已迁移为已读时间")
+    except Exception as e:
+        logger.error(f"迁移已读状态失败: {str(e)}")
+
 if __name__ == '__main__':
+    ensure_indexes()
+    migrate_read_by_to_watermarks()
+    unread_counters.start_reconciler(UNREAD_RECONCILE_INTERVAL, extra_tasks=[reconcile_message_totals])
     PORT = int(os.getenv('PORT', 5003))  # 默认5003端口，支持环境变量覆盖
     socketio.run(app, host='0.0.0.0', port=PORT, debug=False)
     logger.info(f"聊天服务启动在端口 {PORT}") 
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+未读消息计数模块
+在Redis中为每个 (用户, 聊天) 维护未读数：发送消息时递增、标记已读时清零，
+未命中时从Mongo计算后写入，并定期与Mongo对账修正偏差
+"""
+
+import threading
+import time
+
+# 计数器有效期（秒），过期后下次读取时从Mongo重新计算
+COUNTER_TTL = 7 * 24 * 60 * 60
+
+READERS_KEY_PREFIX = 'unread_readers:'
+
+# 只递增已存在的计数器；计数器已过期的读者从读者集合中移除
+# KEYS[1] 为读者集合，KEYS[2..n] 为各读者的计数器，ARGV[1..n-1] 为对应的读者
+INCREMENT_SCRIPT = """
+for i = 2, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('INCR', KEYS[i])
+    else
+        redis.call('SREM', KEYS[1], ARGV[i - 1])
+    end
+end
+return #KEYS - 1
+"""
+
+
+def counter_key(chat_id, user_id):
+    return f"unread:{chat_id}:{user_id}"
+
+
+def readers_key(chat_id):
+    return f"{READERS_KEY_PREFIX}{chat_id}"
+
+
+class UnreadCounters:
+    """
+    未读数计数器
+
+    Args:
+        redis_client: Redis客户端，为None时所有读取直接走Mongo
+        count_from_db: 从Mongo批量计算未读数的函数 (user_id, chat_ids) -> {chat_id: 数量}
+        logger: 日志记录器
+    """
+
+    def __init__(self, redis_client, count_from_db, logger, ttl=COUNTER_TTL):
+        self.redis = redis_client
+        self.count_from_db = count_from_db
+        self.logger = logger
+        self.ttl = ttl
+        self.increment_script = redis_client.register_script(INCREMENT_SCRIPT) if redis_client else None
+
+    def get_many(self, user_id, chat_ids):
+        """批量获取未读数（一次MGET），未缓存的聊天从Mongo批量计算后写入"""
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return {}
+        if not self.redis:
+            return self.count_from_db(user_id, chat_ids)
+
+        try:
+            values = self.redis.mget([counter_key(chat_id, user_id) for chat_id in chat_ids])
+        except Exception as e:
+            self.logger.warning(f"读取未读计数失败，改为从数据库统计: {str(e)}")
+            return self.count_from_db(user_id, chat_ids)
+
+        counts = {}
+        missing = []
+        for chat_id, value in zip(chat_ids, values):
+            if value is None:
+                missing.append(chat_id)
+            else:
+                counts[chat_id] = max(int(value), 0)
+
+        if missing:
+            fresh = self.count_from_db(user_id, missing)
+            counts.update(fresh)
+            try:
+                pipe = self.redis.pipeline()
+                for chat_id in missing:
+                    pipe.sadd(readers_key(chat_id), user_id)
+                    pipe.set(counter_key(chat_id, user_id), fresh[chat_id], ex=self.ttl)
+                pipe.execute()
+            except Exception as e:
+                self.logger.warning(f"写入未读计数失败: {str(e)}")
+
+        return counts
+
+    def get(self, user_id, chat_id):
+        """获取单个聊天的未读数"""
+        return self.get_many(user_id, [chat_id])[chat_id]
+
+    def increment(self, chat_id, sender_id):
+        """新消息：为聊天中除发送者外已缓存计数的读者加一
+
+        先读取读者集合，再把全部计数器键通过 KEYS 传给脚本。两步之间新加入的读者
+        其计数刚从Mongo计算（已包含该消息），偏差由定期对账修正。
+        """
+        if not self.redis:
+            return
+        try:
+            readers = [reader for reader in self.redis.smembers(readers_key(chat_id)) if reader != sender_id]
+            if not readers:
+                return
+            self.increment_script(
+                keys=[readers_key(chat_id)] + [counter_key(chat_id, reader) for reader in readers],
+                args=readers
+            )
+        except Exception as e:
+            self.logger.warning(f"递增未读计数失败: {str(e)}")
+
+    def reset(self, user_id, chat_id):
+        """标记已读：未读数清零"""
+        if not self.redis:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.sadd(readers_key(chat_id), user_id)
+            pipe.set(counter_key(chat_id, user_id), 0, ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self.logger.warning(f"重置未读计数失败: {str(e)}")
+
+    def clear_chat(self, chat_id):
+        """删除聊天的全部计数器"""
+        if not self.redis:
+            return
+        try:
+            readers = self.redis.smembers(readers_key(chat_id))
+            self.redis.delete(readers_key(chat_id), *[counter_key(chat_id, reader) for reader in readers])
+        except Exception as e:
+            self.logger.warning(f"清理未读计数失败: {str(e)}")
+
+    def reconcile(self):
+        """与Mongo对账，修正并发或异常导致的计数偏差，返回修正的计数器数量
+
+        按用户汇总其缓存的全部聊天，每个用户只调用一次 count_from_db，
+        修正结果通过一个管道写回。
+        """
+        if not self.redis:
+            return 0
+
+        # 收集 {user_id: [chat_id]}
+        chats_by_user = {}
+        keys = list(self.redis.scan_iter(f"{READERS_KEY_PREFIX}*", count=100))
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(key)
+        for key, readers in zip(keys, pipe.execute()):
+            chat_id = key[len(READERS_KEY_PREFIX):]
+            for user_id in readers:
+                chats_by_user.setdefault(user_id, []).append(chat_id)
+
+        corrected = 0
+        writes = self.redis.pipeline(transaction=False)
+        for user_id, chat_ids in chats_by_user.items():
+            cached_values = self.redis.mget([counter_key(chat_id, user_id) for chat_id in chat_ids])
+            live_chat_ids = []
+            for chat_id, cached in zip(chat_ids, cached_values):
+                if cached is None:
+                    writes.srem(readers_key(chat_id), user_id)
+                else:
+                    live_chat_ids.append((chat_id, int(cached)))
+            if not live_chat_ids:
+                continue
+
+            actual = self.count_from_db(user_id, [chat_id for chat_id, _ in live_chat_ids])
+            for chat_id, cached in live_chat_ids:
+                if cached != actual[chat_id]:
+                    writes.set(counter_key(chat_id, user_id), actual[chat_id], ex=self.ttl, xx=True)
+                    corrected += 1
+        writes.execute()
+        return corrected
+
+    def start_reconciler(self, interval, extra_tasks=()):
+        """启动后台对账线程，extra_tasks 为同一循环中额外执行的对账函数（如消息总数）"""
+        if not self.redis and not extra_tasks:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    corrected = self.reconcile()
+                    if corrected:
+                        self.logger.info(f"未读计数对账完成，修正 {corrected} 个计数器")
+                except Exception as e:
+                    self.logger.error(f"未读计数对账失败: {str(e)}")
+                for task in extra_tasks:
+                    try:
+                        task()
+                    except Exception as e:
+                        self.logger.error(f"对账任务失败: {str(e)}")
+
+        threading.Thread(target=run, name='unread-reconciler', daemon=True).start()
@@ -8,7 +8,7 @@ from botocore.exceptions import ClientError
 import base64
 import os
 
-def register_websocket_handlers(socketio, db, redis_client, logger):
+def register_websocket_handlers(socketio, db, redis_client, logger, record_new_message, mark_chat_read):
     JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
     R2_ENDPOINT = os.getenv('R2_ENDPOINT')
     R2_ACCESS_KEY = os.getenv('R2_ACCESS_KEY')
@@ -203,16 +203,8 @@ def register_websocket_handlers(socketio, db, redis_client, logger):
             # 广播消息到房间
             socketio.emit('new_message', message_doc, room=room_name)
             
-            # 更新未读计数
-            if chat_id != 'general':
-                # 为私聊更新未读计数
-                private_chat = db.private_chats.find_one({'chat_id': chat_id})
-                if private_chat:
-                    # 为对方增加未读计数
-                    if user_role == 'Member':
-                        redis_client.incr(f"unread:{chat_id}:master")
-                    else:
-                        redis_client.incr(f"unread:{chat_id}:{private_chat['member_id']}")
+            # 更新消息总数和未读计数（与REST接口共用）
+            record_new_message(chat_id, user_id)
             
             logger.info(f"用户 {user_email} 在 {chat_id} 发送消息")
             
@@ -255,11 +247,8 @@ def register_websocket_handlers(socketio, db, redis_client, logger):
             join_room(room_name)
             emit('joined_room', {'room': room_name})
             
-            # 清除未读计数
-            if user_role == 'Member':
-                redis_client.delete(f"unread:{chat_id}:{user_id}")
-            else:
-                redis_client.delete(f"unread:{chat_id}:master")
+            # 标记已读并清除未读计数
+            mark_chat_read(user_id, chat_id)
             
         except Exception as e:
             logger.error(f"加入私聊房间失败: {str(e)}")
@@ -1,4 +1,5 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+from functools import wraps
 from flask_cors import CORS
 import os
 import jwt
@@ -8,16 +9,24 @@ from datetime import datetime, timedelta
 import uuid
 import base64
 import json
+import csv
+import io
 import requests
-from werkzeug.utils import secure_filename
 import logging
-from PIL import Image
-import io
 import threading
+import multiprocessing
+import queue
 import time
 from bson import ObjectId
 import hmac
 import hashlib
+import bisect
+import math
+from image_derivatives import generate_image_derivatives
+import redis
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from botocore.config import Config as BotoConfig
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
@@ -35,12 +44,95 @@ R2_ENDPOINT = os.getenv('R2_ENDPOINT')
 R2_ACCESS_KEY = os.getenv('R2_ACCESS_KEY')
 R2_SECRET_KEY = os.getenv('R2_SECRET_KEY')
 R2_BUCKET = os.getenv('R2_BUCKET')
+R2_UPLOAD_WORKERS = int(os.getenv('R2_UPLOAD_WORKERS', 8))  # 请求路径上的并发上传线程数（原图）
+R2_PRESIGN_EXPIRES = int(os.getenv('R2_PRESIGN_EXPIRES', 600))  # 预签名上传URL有效期（秒）
+DIRECT_UPLOAD_CONTENT_TYPES = ['image/jpeg', 'image/png', 'image/webp']  # 允许直传的图片类型
+MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 单张图片5MB限制
+DERIVATIVE_WORKERS = int(os.getenv('DERIVATIVE_WORKERS', 2))  # 衍生图生成进程数
+DERIVATIVE_UPLOAD_WORKERS = int(os.getenv('DERIVATIVE_UPLOAD_WORKERS', 4))  # 后台衍生图上传线程数
 EXCHANGE_RATE_API_KEY = os.getenv('EXCHANGE_RATE_API_KEY')
 FORTUNE_SERVICE_KEY = os.getenv('FORTUNE_SERVICE_KEY', 'internal-api-key')
+INTERNAL_API_KEY = os.getenv('INTERNAL_API_KEY', FORTUNE_SERVICE_KEY)  # 内部接口 X-Internal-Key 校验
 EMAIL_SERVICE_URL = os.getenv('EMAIL_SERVICE_URL', 'http://email-service:5008')
 PAYMENT_SERVICE_URL = os.getenv('PAYMENT_SERVICE_URL', 'http://payment-service:5006')
 ECOMMERCE_POLLER_URL = os.getenv('ECOMMERCE_POLLER_URL', 'http://ecommerce-poller:3000')
 
+# 汇率进程内缓存配置（秒）
+EXCHANGE_RATE_CACHE_TTL = int(os.getenv('EXCHANGE_RATE_CACHE_TTL', 3600))
+EXCHANGE_RATE_FALLBACK_TTL = int(os.getenv('EXCHANGE_RATE_FALLBACK_TTL', 60))  # 默认汇率的重试间隔
+
+# 队列索引重排模式：bulk（Python内计算排名）或 server（MongoDB内 $setWindowFields 计算排名，需要MongoDB 5.0+），两者都只写回变化的排名
+QUEUE_REINDEX_MODE = os.getenv('QUEUE_REINDEX_MODE', 'bulk')
+QUEUE_REINDEX_DEBOUNCE = float(os.getenv('QUEUE_REINDEX_DEBOUNCE', 2.0))  # 重排防抖窗口（秒）
+
+# 通知发件箱配置
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 20))  # 每批发送数量
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))  # 最大重试次数
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5.0))  # 空闲轮询间隔（秒）
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', 60))  # 发送租约，超时后可被重新领取
+
+# 幂等请求配置（Idempotency-Key请求头）
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 60 * 60))  # 已完成请求的响应保留时间（秒）
+IDEMPOTENCY_LOCK_TTL = int(os.getenv('IDEMPOTENCY_LOCK_TTL', 120))  # 处理中标记的超时时间（秒）
+
+# 回复认领租约（秒），超时未回复的订单可被其他回复者认领
+CLAIM_LEASE_SECONDS = int(os.getenv('CLAIM_LEASE_SECONDS', 15 * 60))
+CLAIMABLE_STATUSES = ['Queued-payed', 'Queued-upload']  # 已支付、可回复的订单
+
+# 等待时间估算：按最近N小时的回复完成数计算吞吐量
+THROUGHPUT_WINDOW_HOURS = int(os.getenv('THROUGHPUT_WINDOW_HOURS', 24))
+THROUGHPUT_CACHE_SECONDS = int(os.getenv('THROUGHPUT_CACHE_SECONDS', 60))  # 吞吐量进程内缓存时间
+
+# 批量排队测试
+PERCENTILE_TEST_LIMIT = 15  # 每小时测试次数
+PERCENTILE_BATCH_MAX = int(os.getenv('PERCENTILE_BATCH_MAX', 20))  # 单次批量测试的最多金额数
+QUEUE_SNAPSHOT_TTL = float(os.getenv('QUEUE_SNAPSHOT_TTL', 30))  # 排队金额快照缓存时间（秒）
+
+# 申请导出
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))  # 导出时每批从Mongo读取的文档数
+EXPORT_SORT = [('created_at', 1), ('_id', 1)]
+EXPORT_FIELDS = [
+    'order_id', 'user_id', 'user_email', 'amount', 'currency', 'converted_amount_cad',
+    'kids_emergency', 'priority', 'status', 'created_at', 'updated_at', 'completed_at'
+]
+EXPORT_PROJECTION = {
+    'user_id': 1, 'user_email': 1, 'amount': 1, 'currency': 1, 'converted_amount_cad': 1,
+    'kids_emergency': 1, 'priority': 1, 'status': 1, 'created_at': 1, 'updated_at': 1,
+    'reply.timestamp': 1
+}
+
+# 实时事件推送（SSE）
+EVENT_CHANNEL_PREFIX = 'fortune:events:'  # Redis发布订阅频道前缀：user:{user_id} / master
+EVENT_HEARTBEAT_SECONDS = int(os.getenv('EVENT_HEARTBEAT_SECONDS', 15))  # 心跳间隔
+EVENT_SUBSCRIBER_BUFFER = int(os.getenv('EVENT_SUBSCRIBER_BUFFER', 100))  # 每个连接缓冲的事件数
+
+# 队列排序规则：紧急优先，其次金额从高到低，最后按提交时间先后
+ACTIVE_QUEUE_STATUSES = ['Pending', 'Queued-payed', 'Queued-upload']
+PAID_STATUSES = ['Queued-payed', 'Queued-upload', 'Completed']  # 计入收入的状态
+
+# 申请状态机：Pending → Queued-payed/Queued-upload → Completed
+STATUS_TRANSITIONS = {
+    'Pending': ['Queued-payed', 'Queued-upload'],
+    'Queued-payed': ['Completed'],
+    'Queued-upload': ['Completed']
+}
+QUEUE_SORT = [('priority', -1), ('converted_amount_cad', -1), ('created_at', 1)]
+LIST_SORT = QUEUE_SORT + [('_id', 1)]  # 列表分页附加_id，保证排序稳定
+LIST_COUNT_CACHE_TTL = int(os.getenv('LIST_COUNT_CACHE_TTL', 30))  # 列表总数缓存时间（秒）
+
+# 列表只读取面板展示的字段（修改历史存放在 fortune_modifications，按需读取）
+LIST_PROJECTION = {
+    'user_id': 1, 'user_email': 1, 'images': 1, 'message': 1, 'amount': 1, 'currency': 1,
+    'converted_amount_cad': 1, 'kids_emergency': 1, 'priority': 1, 'status': 1,
+    'remaining_modifications': 1, 'modification_count': 1, 'queue_index': 1,
+    'created_at': 1, 'updated_at': 1, 'reply': 1
+}
+
+# Redis排队有序集合：成员为 "{创建时间毫秒}:{订单ID}"，同分时按创建时间先后排序
+QUEUE_ZSET_KEY = 'fortune:queue'
+QUEUE_MEMBERS_KEY = 'fortune:queue:members'  # 订单ID -> 有序集合成员
+QUEUE_DIRTY_KEY = 'fortune:queue:dirty'  # 上次重建以来增删过的订单ID，重建时以实时状态为准
+
 # 算命服务采用完全自定义金额模式，用户可以输入任意金额
 # 支持的币种：CNY、USD、CAD、SGD、AUD
 # 支付方式：1. Stripe在线支付  2. 外部支付+上传凭证
@@ -56,7 +148,8 @@ if R2_ENDPOINT and R2_ACCESS_KEY and R2_SECRET_KEY:
         endpoint_url=R2_ENDPOINT,
         aws_access_key_id=R2_ACCESS_KEY,
         aws_secret_access_key=R2_SECRET_KEY,
-        region_name='auto'
+        region_name='auto',
+        config=BotoConfig(max_pool_connections=R2_UPLOAD_WORKERS + DERIVATIVE_UPLOAD_WORKERS)
     )
 else:
     s3_client = None
@@ -65,6 +158,27 @@ else:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Redis连接
+try:
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+    if REDIS_URL.startswith('redis://'):
+        # 解析Redis URL
+        parsed = urllib.parse.urlparse(REDIS_URL)
+        redis_host = parsed.hostname or 'localhost'
+        redis_port = parsed.port or 6379
+        redis_db = int(parsed.path.lstrip('/')) if parsed.path and parsed.path != '/' else 0
+    else:
+        redis_host = 'localhost'
+        redis_port = 6379
+        redis_db = 0
+    
+    redis_client = redis.Redis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
+    redis_client.ping()
+    logger.info(f"Redis连接成功: {redis_host}:{redis_port}")
+except Exception as e:
+    logger.error(f"Redis连接失败: {e}")
+    redis_client = None
+
 def get_exchange_rates():
     """从MongoDB获取最新汇率"""
     try:
@@ -120,66 +234,851 @@ def get_default_rates():
         'AUD': 0.9
     }
 
+# 进程内汇率缓存：rates为汇率表，expires_at为过期时间（monotonic时钟）
+_exchange_rate_cache = {'rates': None, 'expires_at': 0.0}
+_exchange_rate_lock = threading.Lock()
+
+def _store_exchange_rates(rates):
+    """写入汇率缓存（默认汇率只缓存较短时间，以便尽快重试）"""
+    ttl = EXCHANGE_RATE_FALLBACK_TTL if rates == get_default_rates() else EXCHANGE_RATE_CACHE_TTL
+    _exchange_rate_cache['rates'] = rates
+    _exchange_rate_cache['expires_at'] = time.monotonic() + ttl
+
+def get_cached_exchange_rates():
+    """获取进程内缓存的汇率，过期后仅由一个线程刷新"""
+    rates = _exchange_rate_cache['rates']
+    if rates is not None and time.monotonic() < _exchange_rate_cache['expires_at']:
+        return rates
+    
+    # 已有旧汇率时，其他线程不等待刷新，直接使用旧值
+    if rates is not None and not _exchange_rate_lock.acquire(blocking=False):
+        return rates
+    if rates is None:
+        _exchange_rate_lock.acquire()
+    
+    try:
+        # 获取锁后再次检查，避免重复刷新
+        if _exchange_rate_cache['rates'] is not None and time.monotonic() < _exchange_rate_cache['expires_at']:
+            return _exchange_rate_cache['rates']
+        
+        rates = get_exchange_rates()
+        _store_exchange_rates(rates)
+        return rates
+    finally:
+        _exchange_rate_lock.release()
+
+def invalidate_exchange_rate_cache(rates=None):
+    """使汇率缓存失效；如果提供了新汇率则直接写入缓存"""
+    with _exchange_rate_lock:
+        if rates:
+            _store_exchange_rates(rates)
+        else:
+            _exchange_rate_cache['expires_at'] = 0.0
+    logger.info("汇率缓存已" + ("更新" if rates else "失效"))
+
 def convert_to_cad(amount, currency):
     """将金额转换为CAD"""
-    rates = get_exchange_rates()
+    rates = get_cached_exchange_rates()
     return amount * rates.get(currency, 1.0)
 
-def upload_image_to_r2(image_data, filename):
-    """上传图片到R2并生成缩略图"""
-    if not s3_client:
-        raise ValueError("R2存储未配置")
+def queue_score(priority, converted_amount_cad):
+    """计算排队分数：分数越小越靠前（紧急优先，金额按分从高到低）"""
+    return -(priority * 10 ** 12 + round(converted_amount_cad * 100))
+
+def _queue_member(application):
+    """生成有序集合成员（创建时间毫秒补零，保证同分时先提交者靠前）"""
+    created_ms = int(application['created_at'].timestamp() * 1000)
+    return f"{created_ms:013d}:{application['_id']}"
+
+def queue_zset_add(application):
+    """将申请加入Redis排队有序集合"""
+    if not redis_client:
+        return
+    try:
+        member = _queue_member(application)
+        score = queue_score(application.get('priority', 0), application['converted_amount_cad'])
+        pipe = redis_client.pipeline()
+        pipe.zadd(QUEUE_ZSET_KEY, {member: score})
+        pipe.hset(QUEUE_MEMBERS_KEY, str(application['_id']), member)
+        pipe.sadd(QUEUE_DIRTY_KEY, str(application['_id']))
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"加入排队集合失败: {str(e)}")
+
+def queue_zset_remove(order_id):
+    """将申请移出Redis排队有序集合"""
+    if not redis_client:
+        return
+    try:
+        order_id = str(order_id)
+        member = redis_client.hget(QUEUE_MEMBERS_KEY, order_id)
+        pipe = redis_client.pipeline()
+        if member:
+            pipe.zrem(QUEUE_ZSET_KEY, member)
+            pipe.hdel(QUEUE_MEMBERS_KEY, order_id)
+        pipe.sadd(QUEUE_DIRTY_KEY, order_id)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"移出排队集合失败: {str(e)}")
+
+def queue_zset_sync(application):
+    """根据申请当前状态同步排队集合（活跃状态加入，其余移出）"""
+    if application.get('status') in ACTIVE_QUEUE_STATUSES:
+        queue_zset_add(application)
+    else:
+        queue_zset_remove(application['_id'])
+
+def rebuild_queue_zset():
+    """从MongoDB对账排队有序集合（启动时及定时对账）
     
+    以差量方式应用到实时集合：重建期间被 queue_zset_add/remove 改动过的订单
+    （记录在 QUEUE_DIRTY_KEY 中）保留实时状态，不会被快照覆盖。
+    """
+    if not redis_client:
+        return 0
     try:
-        # 解码base64图片
-        if image_data.startswith('data:image'):
-            # 移除data:image/jpeg;base64,前缀
-            image_data = image_data.split(',')[1]
-        
-        image_bytes = base64.b64decode(image_data)
-        
-        # 验证图片大小（5MB限制）
-        if len(image_bytes) > 5 * 1024 * 1024:
-            raise ValueError("图片大小超过5MB限制")
-        
-        # 生成文件名
-        file_key = f"fortune/{datetime.now().strftime('%Y/%m/%d')}/{uuid.uuid4()}_{secure_filename(filename)}"
-        
-        # 上传原图
-        s3_client.put_object(
-            Bucket=R2_BUCKET,
-            Key=file_key,
-            Body=image_bytes,
-            ContentType='image/jpeg'
-        )
-        
-        # 生成缩略图
-        image = Image.open(io.BytesIO(image_bytes))
-        image.thumbnail((300, 300), Image.Resampling.LANCZOS)
-        
-        thumbnail_buffer = io.BytesIO()
-        image.save(thumbnail_buffer, format='JPEG', quality=85)
-        thumbnail_bytes = thumbnail_buffer.getvalue()
-        
-        # 上传缩略图
-        thumbnail_key = f"fortune/thumbnails/{datetime.now().strftime('%Y/%m/%d')}/{uuid.uuid4()}_{secure_filename(filename)}"
-        s3_client.put_object(
-            Bucket=R2_BUCKET,
-            Key=thumbnail_key,
-            Body=thumbnail_bytes,
-            ContentType='image/jpeg'
-        )
+        # 先清空改动记录再读取快照，快照之后的改动都会被记录下来
+        redis_client.delete(QUEUE_DIRTY_KEY)
+        cursor = db.fortune_applications.find(
+            {'status': {'$in': ACTIVE_QUEUE_STATUSES}},
+            {'_id': 1, 'priority': 1, 'converted_amount_cad': 1, 'created_at': 1}
+        ).batch_size(1000)
+        snapshot = {
+            str(app['_id']): (_queue_member(app), queue_score(app.get('priority', 0), app['converted_amount_cad']))
+            for app in cursor
+        }
         
+        added = removed = 0
+        with redis_client.pipeline() as pipe:
+            while True:
+                try:
+                    # 应用差量期间若有新的增删，事务失败后重新计算
+                    pipe.watch(QUEUE_DIRTY_KEY)
+                    dirty = pipe.smembers(QUEUE_DIRTY_KEY)
+                    live = pipe.hgetall(QUEUE_MEMBERS_KEY)
+                    
+                    pipe.multi()
+                    added = removed = 0
+                    for order_id, (member, score) in snapshot.items():
+                        if order_id in dirty:
+                            continue
+                        if live.get(order_id) != member:
+                            if live.get(order_id):
+                                pipe.zrem(QUEUE_ZSET_KEY, live[order_id])
+                            pipe.hset(QUEUE_MEMBERS_KEY, order_id, member)
+                            added += 1
+                        pipe.zadd(QUEUE_ZSET_KEY, {member: score})
+                    for order_id, member in live.items():
+                        if order_id not in snapshot and order_id not in dirty:
+                            pipe.zrem(QUEUE_ZSET_KEY, member)
+                            pipe.hdel(QUEUE_MEMBERS_KEY, order_id)
+                            removed += 1
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        
+        logger.info(f"排队集合对账完成，共 {len(snapshot)} 个申请，补入 {added} 个，移除 {removed} 个")
+        return len(snapshot)
+    except Exception as e:
+        logger.error(f"重建排队集合失败: {str(e)}")
+        return 0
+
+def get_queue_ranks(order_ids):
+    """批量读取申请的排队位置（从1开始），不在队列中的返回None"""
+    if not redis_client or not order_ids:
+        return {}
+    members = redis_client.hmget(QUEUE_MEMBERS_KEY, [str(order_id) for order_id in order_ids])
+    pipe = redis_client.pipeline()
+    for member in members:
+        pipe.zrank(QUEUE_ZSET_KEY, member or '')
+    ranks = pipe.execute()
+    return {
+        str(order_id): (rank + 1 if rank is not None else None)
+        for order_id, rank in zip(order_ids, ranks)
+    }
+
+class FortuneEventBroker:
+    """算命事件广播：每个进程一个Redis订阅线程，按频道分发到本进程的SSE连接
+    
+    Redis不可用时只在本进程内分发。慢连接的缓冲区满时丢弃新事件，不阻塞发布方。
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.listener = None
+    
+    def subscribe(self, channels):
+        """订阅频道，返回接收事件的队列"""
+        subscriber = queue.Queue(maxsize=EVENT_SUBSCRIBER_BUFFER)
+        with self.lock:
+            for channel in channels:
+                self.subscribers.setdefault(channel, set()).add(subscriber)
+            if redis_client and (self.listener is None or not self.listener.is_alive()):
+                self.listener = threading.Thread(target=self._listen, name='fortune-events', daemon=True)
+                self.listener.start()
+        return subscriber
+    
+    def unsubscribe(self, subscriber, channels):
+        """取消订阅"""
+        with self.lock:
+            for channel in channels:
+                subscribers = self.subscribers.get(channel)
+                if subscribers:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.subscribers[channel]
+    
+    def publish(self, channel, event_type, data):
+        """发布事件到频道"""
+        message = json.dumps({'type': event_type, 'data': data}, default=str)
+        if redis_client:
+            try:
+                redis_client.publish(f"{EVENT_CHANNEL_PREFIX}{channel}", message)
+                return
+            except Exception as e:
+                logger.warning(f"发布事件失败，仅在本进程分发: {str(e)}")
+        self._dispatch(channel, message)
+    
+    def publish_many(self, events):
+        """批量发布事件 [(channel, event_type, data)]，通过一个非事务管道一次发送"""
+        messages = [
+            (channel, json.dumps({'type': event_type, 'data': data}, default=str))
+            for channel, event_type, data in events
+        ]
+        if not messages:
+            return
+        if redis_client:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for channel, message in messages:
+                    pipe.publish(f"{EVENT_CHANNEL_PREFIX}{channel}", message)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.warning(f"批量发布事件失败，仅在本进程分发: {str(e)}")
+        for channel, message in messages:
+            self._dispatch(channel, message)
+    
+    def _dispatch(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                pass
+    
+    def _listen(self):
+        """Redis订阅线程，断线后重连"""
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{EVENT_CHANNEL_PREFIX}*")
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self._dispatch(message['channel'][len(EVENT_CHANNEL_PREFIX):], message['data'])
+            except Exception as e:
+                logger.error(f"事件订阅中断，5秒后重连: {str(e)}")
+                time.sleep(5)
+
+fortune_events = FortuneEventBroker()
+
+def publish_application_event(event_type, user_id, data):
+    """向申请所属用户及Master频道推送事件"""
+    try:
+        fortune_events.publish(f'user:{user_id}', event_type, data)
+        fortune_events.publish('master', event_type, data)
+    except Exception as e:
+        logger.error(f"推送事件失败: {str(e)}")
+
+# 统计文档：fortune_stats 集合中 _id 为 global 的全局统计，以及 user:{user_id} 的用户统计
+def _stats_targets(user_id):
+    return ['global', f'user:{user_id}']
+
+def _apply_stats_increments(user_id, increments):
+    """对全局及用户统计文档原子递增（不存在时创建）"""
+    try:
+        increments = {field: value for field, value in increments.items() if value}
+        if not increments:
+            return
+        operations = [
+            pymongo.UpdateOne(
+                {'_id': target},
+                {'$inc': increments, '$set': {'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+            for target in _stats_targets(user_id)
+        ]
+        db.fortune_stats.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.error(f"更新统计数据失败: {str(e)}")
+
+def record_stats_apply(application):
+    """新申请提交时更新统计"""
+    amount_cad = application['converted_amount_cad']
+    currency = application['currency']
+    _apply_stats_increments(application['user_id'], {
+        'total_orders': 1,
+        'total_amount_cad': amount_cad,
+        f"by_status.{application['status']}": 1,
+        f'by_currency.{currency}.orders': 1,
+        f'by_currency.{currency}.amount': application['amount'],
+        f'by_currency.{currency}.amount_cad': amount_cad
+    })
+
+def record_stats_transition(application, old_status, new_status):
+    """申请状态变化时更新统计（进入已支付状态时计入收入）"""
+    if old_status == new_status:
+        return
+    increments = {
+        f'by_status.{old_status}': -1,
+        f'by_status.{new_status}': 1
+    }
+    if old_status not in PAID_STATUSES and new_status in PAID_STATUSES:
+        increments['total_revenue_cad'] = application['converted_amount_cad']
+        increments[f"by_currency.{application['currency']}.revenue_cad"] = application['converted_amount_cad']
+    _apply_stats_increments(application['user_id'], increments)
+
+def rebuild_fortune_stats():
+    """从申请集合全量重建统计文档（仅在统计文档缺失时使用）"""
+    try:
+        rows = db.fortune_applications.aggregate([
+            {'$group': {
+                '_id': {'user_id': '$user_id', 'status': '$status', 'currency': '$currency'},
+                'orders': {'$sum': 1},
+                'amount': {'$sum': '$amount'},
+                'amount_cad': {'$sum': '$converted_amount_cad'}
+            }}
+        ], allowDiskUse=True)
+        
+        documents = {}
+        for row in rows:
+            key = row['_id']
+            for target in _stats_targets(key['user_id']):
+                doc = documents.setdefault(target, {
+                    '_id': target, 'total_orders': 0, 'total_amount_cad': 0.0,
+                    'total_revenue_cad': 0.0, 'by_status': {}, 'by_currency': {}
+                })
+                currency = doc['by_currency'].setdefault(key['currency'], {
+                    'orders': 0, 'amount': 0.0, 'amount_cad': 0.0, 'revenue_cad': 0.0
+                })
+                doc['total_orders'] += row['orders']
+                doc['total_amount_cad'] += row['amount_cad']
+                doc['by_status'][key['status']] = doc['by_status'].get(key['status'], 0) + row['orders']
+                currency['orders'] += row['orders']
+                currency['amount'] += row['amount']
+                currency['amount_cad'] += row['amount_cad']
+                if key['status'] in PAID_STATUSES:
+                    doc['total_revenue_cad'] += row['amount_cad']
+                    currency['revenue_cad'] += row['amount_cad']
+        
+        documents.setdefault('global', {
+            '_id': 'global', 'total_orders': 0, 'total_amount_cad': 0.0,
+            'total_revenue_cad': 0.0, 'by_status': {}, 'by_currency': {}
+        })
+        operations = []
+        for doc in documents.values():
+            doc['updated_at'] = datetime.utcnow()
+            operations.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+        db.fortune_stats.bulk_write(operations, ordered=False)
+        
+        logger.info(f"统计数据重建完成，共 {len(documents)} 个统计文档")
+        return documents['global']
+    except Exception as e:
+        logger.error(f"重建统计数据失败: {str(e)}")
+        return None
+
+def ensure_fortune_stats():
+    """启动时检查统计文档，缺失时从申请集合重建"""
+    try:
+        if not db.fortune_stats.find_one({'_id': 'global'}, {'_id': 1}):
+            rebuild_fortune_stats()
+    except Exception as e:
+        logger.error(f"检查统计数据失败: {str(e)}")
+
+def get_fortune_stats(target='global'):
+    """读取统计文档（O(1)），全局统计缺失时重建"""
+    doc = db.fortune_stats.find_one({'_id': target})
+    if not doc and target == 'global':
+        doc = rebuild_fortune_stats()
+    doc = doc or {}
+    by_status = doc.get('by_status', {})
+    return {
+        'total_orders': doc.get('total_orders', 0),
+        'total_revenue': round(doc.get('total_revenue_cad', 0), 2),
+        'total_amount_cad': round(doc.get('total_amount_cad', 0), 2),
+        'completed_orders': by_status.get('Completed', 0),
+        'pending_orders': by_status.get('Pending', 0),
+        'queued_orders': sum(by_status.get(status, 0) for status in ACTIVE_QUEUE_STATUSES),
+        'by_status': by_status,
+        'by_currency': {
+            currency: {field: round(value, 2) if isinstance(value, float) else value for field, value in values.items()}
+            for currency, values in doc.get('by_currency', {}).items()
+        },
+        'currency': 'CAD',
+        'updated_at': doc['updated_at'].isoformat() if doc.get('updated_at') else None
+    }
+
+class ThroughputEstimator:
+    """回复吞吐量估算：按小时分桶累计完成数，滚动窗口求每小时平均值
+    
+    Redis可用时计数保存在 fortune:throughput:{小时} 键中（多进程共享），否则保存在进程内。
+    回复完成时递增一次；读取的吞吐量在进程内缓存，估算ETA为常数开销。
+    """
+    
+    def __init__(self, window_hours=THROUGHPUT_WINDOW_HOURS):
+        self.window_hours = window_hours
+        self.lock = threading.Lock()
+        self.local_buckets = {}
+        self.cached_rate = None
+        self.cached_at = 0.0
+    
+    @staticmethod
+    def _bucket(moment):
+        return moment.strftime('%Y%m%d%H')
+    
+    def _window_buckets(self):
+        now = datetime.utcnow()
+        return [self._bucket(now - timedelta(hours=offset)) for offset in range(self.window_hours)]
+    
+    def record_completion(self, moment=None):
+        """记录一次回复完成"""
+        bucket = self._bucket(moment or datetime.utcnow())
+        if redis_client:
+            try:
+                key = f"fortune:throughput:{bucket}"
+                pipe = redis_client.pipeline()
+                pipe.incr(key)
+                pipe.expire(key, (self.window_hours + 1) * 3600)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.warning(f"记录回复吞吐量失败: {str(e)}")
+        with self.lock:
+            self.local_buckets[bucket] = self.local_buckets.get(bucket, 0) + 1
+            valid = set(self._window_buckets())
+            for stale in [b for b in self.local_buckets if b not in valid]:
+                del self.local_buckets[stale]
+    
+    def seed_from_database(self):
+        """启动时用窗口内已完成的回复初始化分桶（Redis中已有的分桶不覆盖）"""
+        try:
+            since = datetime.utcnow() - timedelta(hours=self.window_hours)
+            rows = db.fortune_applications.aggregate([
+                {'$match': {'status': 'Completed', 'reply.timestamp': {'$gte': since}}},
+                {'$group': {
+                    '_id': {'$dateToString': {'format': '%Y%m%d%H', 'date': '$reply.timestamp'}},
+                    'count': {'$sum': 1}
+                }}
+            ])
+            counts = {row['_id']: row['count'] for row in rows}
+            if redis_client:
+                pipe = redis_client.pipeline()
+                for bucket, count in counts.items():
+                    pipe.set(f"fortune:throughput:{bucket}", count, nx=True, ex=(self.window_hours + 1) * 3600)
+                pipe.execute()
+            else:
+                with self.lock:
+                    for bucket, count in counts.items():
+                        self.local_buckets.setdefault(bucket, count)
+            logger.info(f"回复吞吐量初始化完成，窗口内共 {sum(counts.values())} 个回复")
+        except Exception as e:
+            logger.error(f"初始化回复吞吐量失败: {str(e)}")
+    
+    def replies_per_hour(self):
+        """窗口内平均每小时完成的回复数"""
+        now = time.monotonic()
+        if self.cached_rate is not None and now - self.cached_at < THROUGHPUT_CACHE_SECONDS:
+            return self.cached_rate
+        
+        buckets = self._window_buckets()
+        total = None
+        if redis_client:
+            try:
+                total = sum(int(value or 0) for value in redis_client.mget([f"fortune:throughput:{b}" for b in buckets]))
+            except Exception as e:
+                logger.warning(f"读取回复吞吐量失败: {str(e)}")
+        if total is None:
+            with self.lock:
+                total = sum(self.local_buckets.get(b, 0) for b in buckets)
+        
+        self.cached_rate = total / self.window_hours
+        self.cached_at = now
+        return self.cached_rate
+    
+    def estimate(self, position):
+        """估算排在 position 的订单的等待时间，吞吐量为0时返回None"""
+        rate = self.replies_per_hour()
+        if not position or rate <= 0:
+            return None
+        eta_hours = position / rate
         return {
-            'original_url': f"{R2_ENDPOINT.rstrip('/')}/{R2_BUCKET}/{file_key}",
-            'thumbnail_url': f"{R2_ENDPOINT.rstrip('/')}/{R2_BUCKET}/{thumbnail_key}",
-            'filename': filename,
-            'upload_time': datetime.utcnow().isoformat()
+            'eta_hours': round(eta_hours, 1),
+            'estimated_completion_at': (datetime.utcnow() + timedelta(hours=eta_hours)).isoformat(),
+            'replies_per_hour': round(rate, 2)
         }
+
+throughput_estimator = ThroughputEstimator()
+
+# 状态转换只读取副作用（排队集合、统计）需要的字段
+TRANSITION_PROJECTION = {
+    'user_id': 1, 'status': 1, 'priority': 1, 'amount': 1, 'currency': 1,
+    'converted_amount_cad': 1, 'created_at': 1
+}
+
+def transition_application(order_id, new_status, query=None, updates=None):
+    """按状态机原子地转换申请状态（一次 find_one_and_update）
+    
+    只有当前状态允许转换到 new_status 且满足 query 时才会更新，否则返回None。
+    转换成功后同步排队集合和统计数据，返回转换后的申请（含 previous_status）。
+    """
+    source_statuses = [status for status, targets in STATUS_TRANSITIONS.items() if new_status in targets]
+    if not source_statuses:
+        return None
+    
+    previous = db.fortune_applications.find_one_and_update(
+        {'_id': ObjectId(order_id), 'status': {'$in': source_statuses}, **(query or {})},
+        {'$set': {'status': new_status, 'updated_at': datetime.utcnow(), **(updates or {})}},
+        projection=TRANSITION_PROJECTION,
+        return_document=pymongo.ReturnDocument.BEFORE
+    )
+    if not previous:
+        return None
+    
+    application = {**previous, 'status': new_status, 'previous_status': previous['status']}
+    queue_zset_sync(application)
+    record_stats_transition(application, previous['status'], new_status)
+    if new_status == 'Completed':
+        throughput_estimator.record_completion()
+    
+    publish_application_event('status', previous['user_id'], {
+        'order_id': str(order_id),
+        'status': new_status,
+        'previous_status': previous['status']
+    })
+    
+    # 离开队列后其他申请的排队位置会变化
+    if new_status not in ACTIVE_QUEUE_STATUSES:
+        queue_reindex_scheduler.trigger()
+    
+    return application
+
+# R2上传线程池（boto3客户端线程安全，所有上传共享同一连接池）
+r2_upload_executor = ThreadPoolExecutor(max_workers=R2_UPLOAD_WORKERS, thread_name_prefix='r2-upload')
+
+def decode_image_data(image_data):
+    """解码base64图片并校验大小"""
+    if image_data.startswith('data:image'):
+        # 移除data:image/jpeg;base64,前缀
+        image_data = image_data.split(',')[1]
+    
+    image_bytes = base64.b64decode(image_data)
+    
+    # 验证图片大小（5MB限制）
+    if len(image_bytes) > MAX_IMAGE_SIZE:
+        raise ValueError("图片大小超过5MB限制")
+    
+    return image_bytes
+
+def _put_r2_object(key, body):
+    """上传单个对象到R2"""
+    return s3_client.put_object(
+        Bucket=R2_BUCKET,
+        Key=key,
+        Body=body,
+        ContentType='image/jpeg'
+    )
+
+def r2_url(key):
+    """R2对象的访问URL"""
+    return f"{R2_ENDPOINT.rstrip('/')}/{R2_BUCKET}/{key}"
+
+def _image_info(key, filename, upload_time, entry=None):
+    """图片信息（衍生图生成前 thumbnail_url 暂时指向原图）
+    
+    entry 为 fortune_images 内容索引记录，已生成过衍生图时直接复用。
+    """
+    info = {
+        'original_url': r2_url(key),
+        'thumbnail_url': r2_url(key),
+        'filename': filename,
+        'upload_time': upload_time,
+        'key': key,
+        'derivatives': 'pending'
+    }
+    if entry:
+        info['content_id'] = entry['_id']
+        if entry.get('derivatives') == 'ready':
+            info.update({
+                'thumbnail_url': entry['thumbnail_url'],
+                'variants': entry.get('variants', {}),
+                'derivatives': 'ready'
+            })
+    return info
+
+def upload_images_to_r2(images, filename_prefix):
+    """按内容哈希上传多张原图到R2，按输入顺序返回图片信息
+    
+    对象key由SHA-256决定，fortune_images 集合记录已存储的内容；相同字节的图片
+    （包括按ETag即内容MD5记录的直传图片）不再重复上传，也不再生成衍生图。
+    新图片并发上传，缩略图等衍生图由 schedule_image_derivatives 在后台生成。
+    任一上传失败时抛出第一个异常。
+    """
+    if not images:
+        return []
+    if not s3_client:
+        raise ValueError("R2存储未配置")
+    
+    try:
+        decoded = []
+        for i, image_data in enumerate(images):
+            image_bytes = decode_image_data(image_data)
+            content_id = f"sha256:{hashlib.sha256(image_bytes).hexdigest()}"
+            # 单次PUT的ETag即内容MD5，与直传图片的索引记录共用同一标识
+            etag = f'"{hashlib.md5(image_bytes).hexdigest()}"'
+            decoded.append((content_id, etag, f"{filename_prefix}_{i+1}.jpg", image_bytes))
+        
+        # 一次查询已存储的内容（按SHA-256或ETag命中，ETag重复时取最早的记录）
+        by_id = {}
+        by_etag = {}
+        for entry in db.fortune_images.find({'$or': [
+            {'_id': {'$in': [content_id for content_id, _, _, _ in decoded]}},
+            {'etag': {'$in': [etag for _, etag, _, _ in decoded]}}
+        ]}).sort('created_at', 1):
+            by_id[entry['_id']] = entry
+            by_etag.setdefault(entry.get('etag'), entry)
+        entries = {}
+        for content_id, etag, _, _ in decoded:
+            entry = by_id.get(content_id) or by_etag.get(etag)
+            if entry:
+                entries[content_id] = entry
+        
+        # 上传未存储过的内容（同一请求内的重复图片只上传一次）
+        pending = {}
+        for content_id, _, _, image_bytes in decoded:
+            if content_id not in entries and content_id not in pending:
+                file_key = f"fortune/content/{content_id[7:9]}/{content_id[7:]}.jpg"
+                pending[content_id] = (file_key, r2_upload_executor.submit(_put_r2_object, file_key, image_bytes))
+        
+        if pending:
+            wait([future for _, future in pending.values()])
+            operations = []
+            for content_id, (file_key, future) in pending.items():
+                # 抛出第一个失败任务的异常
+                response = future.result()
+                entry = {
+                    '_id': content_id,
+                    'key': file_key,
+                    'etag': response.get('ETag'),
+                    'derivatives': 'pending',
+                    'created_at': datetime.utcnow()
+                }
+                entries[content_id] = entry
+                # 按ETag插入，与并发写入的直传记录保持每份内容一条索引
+                operations.append(pymongo.UpdateOne({'etag': entry['etag']}, {'$setOnInsert': entry}, upsert=True))
+            db.fortune_images.bulk_write(operations, ordered=False)
+        
+        upload_time = datetime.utcnow().isoformat()
+        return [
+            _image_info(entries[content_id]['key'], filename, upload_time, entries[content_id])
+            for content_id, _, filename, _ in decoded
+        ]
     except Exception as e:
         logger.error(f"上传图片失败: {str(e)}")
         raise
 
+# 衍生图流水线：线程池负责下载/上传/回写，进程池负责解码和重新编码（不占用请求线程和GIL）
+derivative_executor = ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS, thread_name_prefix='image-derivatives')
+# 衍生图上传使用独立线程池，不与请求路径上的原图上传排队
+derivative_upload_executor = ThreadPoolExecutor(max_workers=DERIVATIVE_UPLOAD_WORKERS, thread_name_prefix='r2-derivatives')
+# 本进程已运行Redis订阅、Mongo监控等线程，fork后子进程可能继承被锁住的锁，改用forkserver/spawn启动。
+# forkserver/spawn会以 __mp_main__ 重新导入主模块，因此服务从 main.py 启动，
+# 避免在工作进程中重复执行本模块的Mongo/Redis/R2初始化
+derivative_process_pool = ProcessPoolExecutor(
+    max_workers=DERIVATIVE_WORKERS,
+    mp_context=multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    )
+)
+
+def _build_image_derivatives(order_id, field, image):
+    """为单张图片生成衍生图、上传到R2并回写申请记录中的图片信息"""
+    key = image['key']
+    content_id = image.get('content_id')
+    try:
+        # 同一内容的衍生图可能已由其他申请生成，直接复用
+        entry = db.fortune_images.find_one({'_id': content_id}) if content_id else None
+        if entry and entry.get('derivatives') == 'ready':
+            db.fortune_applications.update_one(
+                {'_id': ObjectId(order_id)},
+                {'$set': {
+                    f'{field}.$[img].derivatives': 'ready',
+                    f'{field}.$[img].variants': entry.get('variants', {}),
+                    f'{field}.$[img].thumbnail_url': entry['thumbnail_url']
+                }},
+                array_filters=[{'img.key': key}]
+            )
+            return
+        
+        original = s3_client.get_object(Bucket=R2_BUCKET, Key=key)['Body'].read()
+        derivatives = derivative_process_pool.submit(generate_image_derivatives, original).result()
+        
+        date_path = datetime.now().strftime('%Y/%m/%d')
+        base_name = key.rsplit('/', 1)[-1]
+        uploads = {}
+        futures = []
+        for name, (body, content_type) in derivatives.items():
+            if name == 'thumbnail':
+                derivative_key = f"fortune/thumbnails/{date_path}/{base_name}"
+            else:
+                derivative_key = f"fortune/derivatives/{date_path}/{base_name}/{name}"
+            uploads[name] = derivative_key
+            futures.append(derivative_upload_executor.submit(
+                s3_client.put_object, Bucket=R2_BUCKET, Key=derivative_key, Body=body, ContentType=content_type
+            ))
+        
+        wait(futures)
+        for future in futures:
+            future.result()
+        
+        update = {
+            f'{field}.$[img].derivatives': 'ready',
+            f'{field}.$[img].variants': {
+                name.replace('.', '_'): r2_url(derivative_key)
+                for name, derivative_key in uploads.items() if name != 'thumbnail'
+            }
+        }
+        if 'thumbnail' in uploads:
+            update[f'{field}.$[img].thumbnail_url'] = r2_url(uploads['thumbnail'])
+        
+        if content_id:
+            db.fortune_images.update_one({'_id': content_id}, {'$set': {
+                'derivatives': 'ready',
+                'variants': update[f'{field}.$[img].variants'],
+                'thumbnail_url': update.get(f'{field}.$[img].thumbnail_url', r2_url(key))
+            }})
+    except Exception as e:
+        logger.error(f"生成衍生图失败 {key}: {str(e)}")
+        update = {f'{field}.$[img].derivatives': 'failed'}
+    
+    db.fortune_applications.update_one(
+        {'_id': ObjectId(order_id)},
+        {'$set': update},
+        array_filters=[{'img.key': key}]
+    )
+
+def schedule_image_derivatives(order_id, field, images):
+    """异步生成图片衍生图（缩略图、多尺寸WebP/AVIF），完成后回写 field 中对应的图片"""
+    if not s3_client:
+        return
+    for image in images:
+        if image.get('key') and image.get('derivatives') != 'ready':
+            derivative_executor.submit(_build_image_derivatives, str(order_id), field, image)
+
+def direct_upload_prefix(user_id):
+    """用户直传对象的key前缀（用于校验对象归属）"""
+    return f"fortune/uploads/{user_id}/"
+
+def _head_uploaded_image(key):
+    """读取直传对象的元数据并校验大小和类型，不合规的对象直接删除
+    
+    预签名PUT无法限制大小，超限或类型不符的对象只能在这里清理。
+    """
+    head = s3_client.head_object(Bucket=R2_BUCKET, Key=key)
+    error = None
+    if head['ContentLength'] > MAX_IMAGE_SIZE:
+        error = "图片大小超过5MB限制"
+    elif head.get('ContentType') not in DIRECT_UPLOAD_CONTENT_TYPES:
+        error = "不支持的图片类型"
+    if error:
+        s3_client.delete_object(Bucket=R2_BUCKET, Key=key)
+        raise ValueError(error)
+    return head
+
+def resolve_uploaded_images(user_id, image_keys):
+    """校验客户端已直传到R2的对象key，返回与上传接口相同格式的图片信息
+    
+    只发起HEAD请求确认对象存在且大小合法，图片字节不经过本服务。
+    与已存储对象ETag相同的图片会引用已有对象；重复的直传对象只有在没有任何
+    fortune_images 记录、申请和修改历史引用它时才删除，已在索引中的key（如修改申请时
+    重新提交的原图片）直接复用。
+    """
+    if not image_keys:
+        return []
+    if not s3_client:
+        raise ValueError("R2存储未配置")
+    
+    prefix = direct_upload_prefix(user_id)
+    for key in image_keys:
+        if not isinstance(key, str) or not key.startswith(prefix) or '..' in key:
+            raise ValueError("无效的图片key")
+    
+    futures = [r2_upload_executor.submit(_head_uploaded_image, key) for key in image_keys]
+    wait(futures)
+    etags = []
+    for future in futures:
+        try:
+            etags.append(future.result().get('ETag'))
+        except ValueError:
+            raise
+        except Exception:
+            raise ValueError("图片尚未上传或已过期")
+    
+    # 按key或ETag（单次PUT时为内容MD5）查找已存储的相同内容，ETag重复时取最早的记录
+    by_key = {}
+    by_etag = {}
+    for entry in db.fortune_images.find({'$or': [
+        {'key': {'$in': list(image_keys)}},
+        {'etag': {'$in': [etag for etag in etags if etag]}}
+    ]}).sort('created_at', 1):
+        by_key[entry['key']] = entry
+        by_etag.setdefault(entry.get('etag'), entry)
+    
+    upload_time = datetime.utcnow().isoformat()
+    images = []
+    duplicates = []
+    for key, etag in zip(image_keys, etags):
+        entry = by_key.get(key)
+        if not entry and etag:
+            entry = by_etag.get(etag)
+            if entry:
+                duplicates.append(key)
+            else:
+                entry = {
+                    '_id': 'etag:' + etag.strip('"'),
+                    'key': key,
+                    'etag': etag,
+                    'derivatives': 'pending',
+                    'created_at': datetime.utcnow()
+                }
+                db.fortune_images.update_one({'_id': entry['_id']}, {'$setOnInsert': entry}, upsert=True)
+                by_key[key] = by_etag[etag] = entry
+        images.append(_image_info(entry['key'] if entry else key, key.rsplit('/', 1)[-1], upload_time, entry))
+    
+    if duplicates:
+        # 仅删除未被任何申请及修改历史引用的重复直传对象
+        referenced = set()
+        for application in db.fortune_applications.find({'$or': [
+            {'images.key': {'$in': duplicates}},
+            {'payment_screenshots.key': {'$in': duplicates}},
+            {'reply.images.key': {'$in': duplicates}}
+        ]}, {'images.key': 1, 'payment_screenshots.key': 1, 'reply.images.key': 1}):
+            for image in (application.get('images') or []) + (application.get('payment_screenshots') or []) \
+                    + ((application.get('reply') or {}).get('images') or []):
+                referenced.add(image.get('key'))
+        for modification in db.fortune_modifications.find({'$or': [
+            {'old_images.key': {'$in': duplicates}},
+            {'new_images.key': {'$in': duplicates}}
+        ]}, {'old_images.key': 1, 'new_images.key': 1}):
+            for image in (modification.get('old_images') or []) + (modification.get('new_images') or []):
+                referenced.add(image.get('key'))
+        for key in set(duplicates) - referenced:
+            r2_upload_executor.submit(s3_client.delete_object, Bucket=R2_BUCKET, Key=key)
+    
+    return images
+
 def verify_token():
     """验证JWT Token（支持Supabase和传统JWT）"""
     token = request.cookies.get('access_token') or request.cookies.get('sb-access-token')
@@ -211,27 +1110,116 @@ def verify_token():
         return None
 
 def send_email_notification(email_type, user_id, **kwargs):
-    """发送邮件通知"""
-    try:
+    """发送邮件通知（写入发件箱，由后台分发线程发送）"""
+    enqueue_notification('email', {
+        'type': email_type,
+        'user_id': user_id,
+        **kwargs
+    })
+
+def _deliver_email_notification(payload):
+    """实际发送邮件通知"""
+    response = requests.post(
+        f"{EMAIL_SERVICE_URL}/send",
+        json=payload,
+        timeout=10
+    )
+    
+    if response.status_code == 200:
+        logger.info(f"邮件通知发送成功: {payload.get('type')}")
+    elif 400 <= response.status_code < 500:
+        raise NotificationRejected(f"邮件服务拒绝: {response.status_code}")
+    else:
+        raise RuntimeError(f"邮件通知发送失败: {response.status_code}")
+
+def request_fingerprint():
+    """请求内容的规范化指纹
+    
+    JSON按键排序，表单按字段名排序、文件按内容哈希，与序列化方式和multipart边界无关，
+    经网关重新编码的重试请求得到相同指纹。
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        files = {}
+        for name in request.files:
+            hashes = []
+            for file in request.files.getlist(name):
+                hashes.append(hashlib.sha256(file.read()).hexdigest())
+                file.seek(0)
+            files[name] = hashes
         payload = {
-            'type': email_type,
-            'user_id': user_id,
-            **kwargs
+            'form': {name: request.form.getlist(name) for name in request.form},
+            'files': files
         }
-        
-        response = requests.post(
-            f"{EMAIL_SERVICE_URL}/send",
-            json=payload,
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            logger.info(f"邮件通知发送成功: {email_type}")
-        else:
-            logger.warning(f"邮件通知发送失败: {response.status_code}")
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def idempotent_request(scope):
+    """幂等请求装饰器：相同 Idempotency-Key 的重试直接返回首次成功的响应
+    
+    状态保存在Redis中：处理中时返回409，请求体不一致时返回422，
+    失败的请求会清除标记以便客户端重试。未携带请求头或Redis不可用时按普通请求处理。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            idempotency_key = request.headers.get('Idempotency-Key')
+            user_payload = verify_token() if idempotency_key else None
+            if not idempotency_key or not redis_client or not user_payload:
+                return f(*args, **kwargs)
             
-    except Exception as e:
-        logger.error(f"发送邮件通知失败: {str(e)}")
+            if len(idempotency_key) > 128:
+                return jsonify({'error': 'Idempotency-Key过长'}), 400
+            
+            cache_key = f"fortune:idempotency:{scope}:{user_payload['sub']}:{idempotency_key}"
+            fingerprint = request_fingerprint()
+            
+            try:
+                # 标记在SET NX失败与GET之间过期时重新抢占，只有持有标记才执行请求
+                for _ in range(3):
+                    acquired = redis_client.set(
+                        cache_key,
+                        json.dumps({'state': 'processing', 'fingerprint': fingerprint}),
+                        nx=True,
+                        ex=IDEMPOTENCY_LOCK_TTL
+                    )
+                    if acquired:
+                        break
+                    record = json.loads(redis_client.get(cache_key) or '{}')
+                    if not record:
+                        continue
+                    if record.get('fingerprint') and record['fingerprint'] != fingerprint:
+                        return jsonify({'error': 'Idempotency-Key已用于其他请求'}), 422
+                    if record.get('state') == 'done':
+                        response = app.response_class(
+                            record['body'], status=record['status_code'], mimetype='application/json'
+                        )
+                        response.headers['Idempotent-Replayed'] = 'true'
+                        return response
+                    return jsonify({'error': '请求正在处理中'}), 409
+                else:
+                    return jsonify({'error': '请求正在处理中'}), 409
+            except Exception as e:
+                logger.warning(f"读取幂等记录失败，按普通请求处理: {str(e)}")
+                return f(*args, **kwargs)
+            
+            response = app.make_response(f(*args, **kwargs))
+            
+            try:
+                if 200 <= response.status_code < 300:
+                    redis_client.set(cache_key, json.dumps({
+                        'state': 'done',
+                        'fingerprint': fingerprint,
+                        'status_code': response.status_code,
+                        'body': response.get_data(as_text=True)
+                    }), ex=IDEMPOTENCY_TTL)
+                else:
+                    redis_client.delete(cache_key)
+            except Exception as e:
+                logger.warning(f"保存幂等记录失败: {str(e)}")
+            
+            return response
+        return decorated_function
+    return decorator
 
 @app.route('/health')
 def health():
@@ -241,7 +1229,7 @@ def health():
         mongo_client.admin.command('ping')
         
         # 检查汇率数据
-        rates = get_exchange_rates()
+        rates = get_cached_exchange_rates()
         
         return jsonify({
             'status': 'healthy',
@@ -259,6 +1247,7 @@ def health():
         }), 500
 
 @app.route('/fortune/apply', methods=['POST'])
+@idempotent_request('apply')
 def apply_fortune():
     """提交算命申请"""
     try:
@@ -270,13 +1259,16 @@ def apply_fortune():
         user_id = user_payload['sub']
         data = request.get_json()
         
-        # 验证必填字段
-        required_fields = ['images', 'message', 'amount', 'currency']
+        # 验证必填字段（图片可以是base64内容images，或预签名直传后的image_keys）
+        required_fields = ['message', 'amount', 'currency']
         for field in required_fields:
             if field not in data:
                 return jsonify({'error': f'缺少必填字段: {field}'}), 400
+        if 'images' not in data and 'image_keys' not in data:
+            return jsonify({'error': '缺少必填字段: images'}), 400
         
-        images = data['images']
+        image_keys = data.get('image_keys')
+        images = image_keys if image_keys is not None else data['images']
         message = data['message'].strip()
         amount = float(data['amount'])
         currency = data['currency'].upper()
@@ -296,14 +1288,13 @@ def apply_fortune():
             return jsonify({'error': '金额必须大于0'}), 400
         
         # 上传图片
-        uploaded_images = []
-        for i, image_data in enumerate(images):
-            try:
-                filename = f"image_{i+1}.jpg"
-                image_info = upload_image_to_r2(image_data, filename)
-                uploaded_images.append(image_info)
-            except Exception as e:
-                return jsonify({'error': f'图片上传失败: {str(e)}'}), 400
+        try:
+            if image_keys is not None:
+                uploaded_images = resolve_uploaded_images(user_id, image_keys)
+            else:
+                uploaded_images = upload_images_to_r2(images, 'image')
+        except Exception as e:
+            return jsonify({'error': f'图片上传失败: {str(e)}'}), 400
         
         # 转换金额为CAD
         converted_amount_cad = convert_to_cad(amount, currency)
@@ -320,7 +1311,7 @@ def apply_fortune():
             'kids_emergency': kids_emergency,
             'priority': 1 if kids_emergency else 0,  # 紧急订单优先级为1
             'status': 'Pending',
-            'modifications': [],
+            'modification_count': 0,
             'remaining_modifications': 5,
             'created_at': datetime.utcnow(),
             'updated_at': datetime.utcnow(),
@@ -329,9 +1320,18 @@ def apply_fortune():
         
         result = db.fortune_applications.insert_one(application)
         order_id = str(result.inserted_id)
+        queue_zset_add(application)
+        schedule_image_derivatives(order_id, 'images', uploaded_images)
+        record_stats_apply(application)
+        publish_application_event('created', user_id, {
+            'order_id': order_id,
+            'status': 'Pending',
+            'priority': application['priority'],
+            'converted_amount_cad': round(converted_amount_cad, 2)
+        })
         
         # 触发队列索引更新（异步）
-        threading.Thread(target=update_queue_indexes).start()
+        queue_reindex_scheduler.trigger()
         
         logger.info(f"用户 {user_id} 提交算命申请: {order_id}, 金额: {amount} {currency}, 紧急: {kids_emergency}")
         
@@ -347,6 +1347,128 @@ def apply_fortune():
         logger.error(f"提交申请失败: {str(e)}")
         return jsonify({'error': '提交失败'}), 500
 
+@app.route('/fortune/upload-url', methods=['POST'])
+def create_upload_urls():
+    """签发预签名直传URL（客户端直接PUT图片到R2，再用key提交申请）"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        if not s3_client:
+            return jsonify({'error': 'R2存储未配置'}), 503
+        
+        user_id = user_payload['sub']
+        data = request.get_json(silent=True) or {}
+        count = int(data.get('count', 1))
+        content_type = data.get('content_type', 'image/jpeg')
+        
+        if count < 1 or count > 3:
+            return jsonify({'error': '最多只能上传3张图片'}), 400
+        
+        if content_type not in DIRECT_UPLOAD_CONTENT_TYPES:
+            return jsonify({'error': '不支持的图片格式'}), 400
+        
+        prefix = direct_upload_prefix(user_id)
+        date_path = datetime.utcnow().strftime('%Y/%m/%d')
+        uploads = []
+        for _ in range(count):
+            key = f"{prefix}{date_path}/{uuid.uuid4()}"
+            upload_url = s3_client.generate_presigned_url(
+                'put_object',
+                Params={'Bucket': R2_BUCKET, 'Key': key, 'ContentType': content_type},
+                ExpiresIn=R2_PRESIGN_EXPIRES
+            )
+            uploads.append({'key': key, 'upload_url': upload_url})
+        
+        return jsonify({
+            'uploads': uploads,
+            'content_type': content_type,
+            'max_size': MAX_IMAGE_SIZE,
+            'expires_in': R2_PRESIGN_EXPIRES
+        })
+        
+    except Exception as e:
+        logger.error(f"签发上传URL失败: {str(e)}")
+        return jsonify({'error': '签发上传URL失败'}), 500
+
+def format_application(app, queue_index=None):
+    """格式化申请记录（列表与详情共用）"""
+    formatted_app = {
+        'id': str(app['_id']),
+        'user_id': app['user_id'],
+        'user_email': app.get('user_email'),
+        'images': app['images'],
+        'message': app['message'],
+        'amount': app['amount'],
+        'currency': app['currency'],
+        'converted_amount_cad': round(app['converted_amount_cad'], 2),
+        'kids_emergency': app.get('kids_emergency', False),
+        'priority': app.get('priority', 0),
+        'status': app['status'],
+        'remaining_modifications': app.get('remaining_modifications', 5),
+        'modification_count': app.get('modification_count', 5 - app.get('remaining_modifications', 5)),
+        'queue_index': queue_index or app.get('queue_index'),
+        'created_at': app['created_at'].isoformat(),
+        'updated_at': app['updated_at'].isoformat()
+    }
+    
+    # 添加回复内容（如果有）
+    if 'reply' in app:
+        formatted_app['reply'] = app['reply']
+    
+    return formatted_app
+
+def encode_list_cursor(application):
+    """将最后一条记录的排序键编码为不透明的分页游标"""
+    payload = json.dumps([
+        application.get('priority', 0),
+        application['converted_amount_cad'],
+        application['created_at'].isoformat(),
+        str(application['_id'])
+    ], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_list_cursor(token):
+    """解码分页游标，返回 (priority, converted_amount_cad, created_at, _id)"""
+    padded = token + '=' * (-len(token) % 4)
+    priority, amount, created_at, order_id = json.loads(base64.urlsafe_b64decode(padded))
+    return int(priority), float(amount), datetime.fromisoformat(created_at), ObjectId(order_id)
+
+def keyset_after(sort_key):
+    """构造排在给定排序键之后的查询条件（与LIST_SORT方向一致）"""
+    priority, amount, created_at, order_id = sort_key
+    return {'$or': [
+        {'priority': {'$lt': priority}},
+        {'priority': priority, 'converted_amount_cad': {'$lt': amount}},
+        {'priority': priority, 'converted_amount_cad': amount, 'created_at': {'$gt': created_at}},
+        {'priority': priority, 'converted_amount_cad': amount, 'created_at': created_at, '_id': {'$gt': order_id}}
+    ]}
+
+def get_cached_count(query):
+    """获取查询的文档总数（Redis短时缓存，避免每次请求都count_documents）"""
+    cache_key = None
+    if redis_client:
+        try:
+            digest = hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            cache_key = f"fortune:count:{digest}"
+            cached = redis_client.get(cache_key)
+            if cached is not None:
+                return int(cached)
+        except Exception as e:
+            logger.warning(f"读取列表总数缓存失败: {str(e)}")
+            cache_key = None
+    
+    total = db.fortune_applications.count_documents(query)
+    
+    if cache_key:
+        try:
+            redis_client.setex(cache_key, LIST_COUNT_CACHE_TTL, total)
+        except Exception as e:
+            logger.warning(f"写入列表总数缓存失败: {str(e)}")
+    
+    return total
+
 @app.route('/fortune/list')
 def list_fortune_applications():
     """获取算命申请列表"""
@@ -362,6 +1484,11 @@ def list_fortune_applications():
         limit = min(int(request.args.get('limit', 20)), 50)
         status_filter = request.args.get('status')
         
+        # 游标分页：传入cursor（或paginate=cursor开始第一页），默认不返回总数
+        cursor_token = request.args.get('cursor')
+        cursor_mode = bool(cursor_token) or request.args.get('paginate') == 'cursor'
+        include_total = request.args.get('include_total', 'false' if cursor_mode else 'true').lower() == 'true'
+        
         # 构建查询条件
         query = {}
         
@@ -373,59 +1500,122 @@ def list_fortune_applications():
             query['status'] = status_filter
         
         # 分页查询
-        skip = (page - 1) * limit
-        applications = list(db.fortune_applications.find(query)
-                          .sort([('priority', -1), ('converted_amount_cad', -1), ('created_at', 1)])
-                          .skip(skip)
-                          .limit(limit))
+        if cursor_mode:
+            find_query = query
+            if cursor_token:
+                try:
+                    find_query = {'$and': [query, keyset_after(decode_list_cursor(cursor_token))]}
+                except Exception:
+                    return jsonify({'error': '无效的分页游标'}), 400
+            
+            # 多取一条用于判断是否还有下一页
+            applications = list(db.fortune_applications.find(find_query, LIST_PROJECTION)
+                              .sort(LIST_SORT)
+                              .limit(limit + 1))
+            has_more = len(applications) > limit
+            applications = applications[:limit]
+        else:
+            skip = (page - 1) * limit
+            applications = list(db.fortune_applications.find(query, LIST_PROJECTION)
+                              .sort(LIST_SORT)
+                              .skip(skip)
+                              .limit(limit))
         
-        total = db.fortune_applications.count_documents(query)
+        total = get_cached_count(query) if include_total else None
+        
+        # 从排队有序集合读取实时排队位置
+        queue_ranks = {}
+        try:
+            queue_ranks = get_queue_ranks([
+                app['_id'] for app in applications if app['status'] in ACTIVE_QUEUE_STATUSES
+            ])
+        except Exception as e:
+            logger.warning(f"读取排队位置失败，使用数据库中的queue_index: {str(e)}")
         
         # 格式化返回数据
-        formatted_applications = []
-        for app in applications:
-            formatted_app = {
-                'id': str(app['_id']),
-                'user_id': app['user_id'],
-                'user_email': app.get('user_email'),
-                'images': app['images'],
-                'message': app['message'],
-                'amount': app['amount'],
-                'currency': app['currency'],
-                'converted_amount_cad': round(app['converted_amount_cad'], 2),
-                'kids_emergency': app.get('kids_emergency', False),
-                'priority': app.get('priority', 0),
-                'status': app['status'],
-                'remaining_modifications': app.get('remaining_modifications', 5),
-                'queue_index': app.get('queue_index'),
-                'created_at': app['created_at'].isoformat(),
-                'updated_at': app['updated_at'].isoformat()
-            }
-            
-            # 添加修改历史
-            if 'modifications' in app:
-                formatted_app['modifications'] = app['modifications']
-            
-            # 添加回复内容（如果有）
-            if 'reply' in app:
-                formatted_app['reply'] = app['reply']
-            
-            formatted_applications.append(formatted_app)
+        formatted_applications = [
+            format_application(app, queue_ranks.get(str(app['_id']))) for app in applications
+        ]
         
-        return jsonify({
-            'applications': formatted_applications,
-            'pagination': {
-                'page': page,
+        # 排队中的申请附带预计等待时间
+        for formatted_app in formatted_applications:
+            if formatted_app['status'] in ACTIVE_QUEUE_STATUSES:
+                formatted_app['eta'] = throughput_estimator.estimate(formatted_app['queue_index'])
+        
+        if cursor_mode:
+            pagination = {
                 'limit': limit,
-                'total': total,
-                'total_pages': (total + limit - 1) // limit
+                'has_more': has_more,
+                'next_cursor': encode_list_cursor(applications[-1]) if has_more else None
             }
+            if include_total:
+                pagination['total'] = total
+        else:
+            pagination = {
+                'page': page,
+                'limit': limit,
+                'total': total,
+                'total_pages': (total + limit - 1) // limit if total is not None else None
+            }
+        
+        return jsonify({
+            'applications': formatted_applications,
+            'pagination': pagination
         })
         
     except Exception as e:
         logger.error(f"获取申请列表失败: {str(e)}")
         return jsonify({'error': '获取列表失败'}), 500
 
+@app.route('/fortune/applications/<order_id>')
+def get_fortune_application(order_id):
+    """获取算命申请详情（包含修改历史和支付凭证）"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        user_id = user_payload['sub']
+        user_role = user_payload.get('role', 'user')
+        
+        query = {'_id': ObjectId(order_id)}
+        
+        # 普通用户只能看自己的申请
+        if user_role not in ['Master', 'Firstmate', 'admin']:
+            query['user_id'] = user_id
+        
+        app = db.fortune_applications.find_one(query)
+        if not app:
+            return jsonify({'error': '申请不存在'}), 404
+        
+        queue_index = None
+        if app['status'] in ACTIVE_QUEUE_STATUSES:
+            try:
+                queue_index = get_queue_ranks([app['_id']]).get(str(app['_id']))
+            except Exception as e:
+                logger.warning(f"读取排队位置失败，使用数据库中的queue_index: {str(e)}")
+        
+        formatted_app = format_application(app, queue_index)
+        
+        if 'payment_screenshots' in app:
+            formatted_app['payment_screenshots'] = app['payment_screenshots']
+        
+        # 修改历史：旧数据内嵌在文档中，新数据在 fortune_modifications 集合
+        modifications = list(app.get('modifications', []))
+        modifications.extend(
+            db.fortune_modifications.find(
+                {'application_id': app['_id']},
+                {'_id': 0, 'application_id': 0, 'user_id': 0}
+            ).sort('timestamp', 1)
+        )
+        formatted_app['modifications'] = modifications
+        
+        return jsonify({'application': formatted_app})
+        
+    except Exception as e:
+        logger.error(f"获取申请详情失败: {str(e)}")
+        return jsonify({'error': '获取详情失败'}), 500
+
 @app.route('/fortune/modify', methods=['POST'])
 def modify_fortune_application():
     """修改算命申请"""
@@ -439,7 +1629,8 @@ def modify_fortune_application():
         
         order_id = data.get('order_id')
         new_message = data.get('message', '').strip()
-        new_images = data.get('images', [])
+        image_keys = data.get('image_keys')
+        new_images = image_keys if image_keys is not None else data.get('images', [])
         
         if not order_id:
             return jsonify({'error': '缺少订单ID'}), 400
@@ -448,7 +1639,7 @@ def modify_fortune_application():
         application = db.fortune_applications.find_one({
             '_id': ObjectId(order_id),
             'user_id': user_id
-        })
+        }, {'message': 1, 'images': 1, 'status': 1, 'remaining_modifications': 1})
         
         if not application:
             return jsonify({'error': '申请不存在'}), 404
@@ -472,29 +1663,30 @@ def modify_fortune_application():
         # 上传新图片
         uploaded_images = []
         if new_images:
-            for i, image_data in enumerate(new_images):
-                try:
-                    filename = f"modified_image_{i+1}.jpg"
-                    image_info = upload_image_to_r2(image_data, filename)
-                    uploaded_images.append(image_info)
-                except Exception as e:
-                    return jsonify({'error': f'图片上传失败: {str(e)}'}), 400
+            try:
+                if image_keys is not None:
+                    uploaded_images = resolve_uploaded_images(user_id, image_keys)
+                else:
+                    uploaded_images = upload_images_to_r2(new_images, 'modified_image')
+            except Exception as e:
+                return jsonify({'error': f'图片上传失败: {str(e)}'}), 400
         
-        # 记录修改历史
-        modification = {
+        # 记录修改历史（独立集合，申请文档不随修改次数增长）
+        db.fortune_modifications.insert_one({
+            'application_id': ObjectId(order_id),
+            'user_id': user_id,
             'timestamp': datetime.utcnow(),
             'old_message': application['message'],
             'new_message': new_message,
             'old_images': application['images'],
             'new_images': uploaded_images
-        }
+        })
         
         # 更新申请
         update_data = {
             'message': new_message,
             'updated_at': datetime.utcnow(),
-            'remaining_modifications': remaining_modifications - 1,
-            '$push': {'modifications': modification}
+            'remaining_modifications': remaining_modifications - 1
         }
         
         if uploaded_images:
@@ -502,9 +1694,12 @@ def modify_fortune_application():
         
         db.fortune_applications.update_one(
             {'_id': ObjectId(order_id)},
-            {'$set': update_data}
+            {'$set': update_data, '$inc': {'modification_count': 1}}
         )
         
+        if uploaded_images:
+            schedule_image_derivatives(order_id, 'images', uploaded_images)
+        
         logger.info(f"用户 {user_id} 修改申请: {order_id}")
         
         return jsonify({
@@ -540,12 +1735,11 @@ def reply_fortune_application():
         if not order_id or not reply_content:
             return jsonify({'error': '缺少必填字段'}), 400
         
-        # 验证申请存在
-        application = db.fortune_applications.find_one({'_id': ObjectId(order_id)})
-        if not application:
-            return jsonify({'error': '申请不存在'}), 404
-        
         if is_draft:
+            # 验证申请存在
+            if not db.fortune_applications.find_one({'_id': ObjectId(order_id)}, {'_id': 1}):
+                return jsonify({'error': '申请不存在'}), 404
+            
             # 保存草稿到Redis
             draft_key = f"fortune_draft:{order_id}:{user_id}"
             draft_data = {
@@ -558,16 +1752,20 @@ def reply_fortune_application():
             return jsonify({'success': True, 'message': '草稿已保存'})
         
         else:
+            # 上传前先确认订单可回复且未被他人认领，避免为无法回复的订单写入R2对象
+            if not ObjectId.is_valid(order_id) or not db.fortune_applications.find_one(
+                {'_id': ObjectId(order_id), 'status': {'$in': CLAIMABLE_STATUSES}, **unclaimed_or_claimed_by(user_id)},
+                {'_id': 1}
+            ):
+                return jsonify({'error': '申请不存在或当前状态不允许回复'}), 409
+            
             # 上传回复图片
             uploaded_reply_images = []
             if reply_images:
-                for i, image_data in enumerate(reply_images):
-                    try:
-                        filename = f"reply_image_{i+1}.jpg"
-                        image_info = upload_image_to_r2(image_data, filename)
-                        uploaded_reply_images.append(image_info)
-                    except Exception as e:
-                        return jsonify({'error': f'回复图片上传失败: {str(e)}'}), 400
+                try:
+                    uploaded_reply_images = upload_images_to_r2(reply_images, 'reply_image')
+                except Exception as e:
+                    return jsonify({'error': f'回复图片上传失败: {str(e)}'}), 400
             
             # 发布回复
             reply_data = {
@@ -578,16 +1776,21 @@ def reply_fortune_application():
                 'timestamp': datetime.utcnow()
             }
             
-            db.fortune_applications.update_one(
-                {'_id': ObjectId(order_id)},
-                {
-                    '$set': {
-                        'status': 'Completed',
-                        'reply': reply_data,
-                        'updated_at': datetime.utcnow()
-                    }
-                }
+            # 已被其他回复者认领且租约未过期的订单不能回复（条件更新防止上传期间的并发状态变化）
+            application = transition_application(
+                order_id, 'Completed',
+                query=unclaimed_or_claimed_by(user_id),
+                updates={'reply': reply_data}
             )
+            if not application:
+                return jsonify({'error': '申请不存在或当前状态不允许回复'}), 409
+            
+            schedule_image_derivatives(order_id, 'reply.images', uploaded_reply_images)
+            publish_application_event('reply', application['user_id'], {
+                'order_id': order_id,
+                'replier_role': user_role,
+                'timestamp': reply_data['timestamp'].isoformat()
+            })
             
             # 删除草稿
             draft_key = f"fortune_draft:{order_id}:{user_id}"
@@ -604,6 +1807,286 @@ def reply_fortune_application():
         logger.error(f"回复申请失败: {str(e)}")
         return jsonify({'error': '回复失败'}), 500
 
+def unclaimed_or_claimed_by(user_id):
+    """未被认领、认领已过期或由该用户认领的订单条件"""
+    return {'$or': [
+        {'claimed_until': None},
+        {'claimed_until': {'$lte': datetime.utcnow()}},
+        {'claimed_by': user_id}
+    ]}
+
+@app.route('/fortune/claim-next', methods=['POST'])
+def claim_next_application():
+    """认领队列中下一个待回复的订单（Master/Firstmate专用）"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        user_id = user_payload['sub']
+        user_role = user_payload.get('role', 'user')
+        
+        if user_role not in ['Master', 'Firstmate', 'admin']:
+            return jsonify({'error': '无权限'}), 403
+        
+        now = datetime.utcnow()
+        claimed_until = now + timedelta(seconds=CLAIM_LEASE_SECONDS)
+        
+        # 已持有未过期的认领时续期该订单，而不是再认领一个新订单
+        application = db.fortune_applications.find_one_and_update(
+            {'status': {'$in': CLAIMABLE_STATUSES}, 'claimed_by': user_id, 'claimed_until': {'$gt': now}},
+            {'$set': {'claimed_until': claimed_until}},
+            projection={'modifications': 0},
+            sort=LIST_SORT,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        renewed = application is not None
+        
+        # 否则按队列顺序原子认领下一个未被认领（或认领已过期）的订单
+        if not application:
+            application = db.fortune_applications.find_one_and_update(
+                {'status': {'$in': CLAIMABLE_STATUSES}, '$or': [
+                    {'claimed_until': None},
+                    {'claimed_until': {'$lte': now}}
+                ]},
+                {'$set': {
+                    'claimed_by': user_id,
+                    'claimed_role': user_role,
+                    'claimed_at': now,
+                    'claimed_until': claimed_until
+                }},
+                projection={'modifications': 0},
+                sort=LIST_SORT,
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        
+        if not application:
+            return jsonify({'application': None, 'message': '暂无待回复的订单'})
+        
+        formatted_app = format_application(application)
+        if 'payment_screenshots' in application:
+            formatted_app['payment_screenshots'] = application['payment_screenshots']
+        formatted_app['claimed_until'] = application['claimed_until'].isoformat()
+        
+        logger.info(f"{user_role} {user_id} {'续期' if renewed else '认领'}申请: {formatted_app['id']}")
+        
+        return jsonify({'application': formatted_app, 'lease_seconds': CLAIM_LEASE_SECONDS, 'renewed': renewed})
+        
+    except Exception as e:
+        logger.error(f"认领订单失败: {str(e)}")
+        return jsonify({'error': '认领失败'}), 500
+
+@app.route('/fortune/claim/release', methods=['POST'])
+def release_application_claim():
+    """释放自己认领的订单"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        user_id = user_payload['sub']
+        data = request.get_json()
+        order_id = data.get('order_id')
+        
+        if not order_id:
+            return jsonify({'error': '缺少订单ID'}), 400
+        
+        result = db.fortune_applications.update_one(
+            {'_id': ObjectId(order_id), 'claimed_by': user_id},
+            {'$unset': {'claimed_by': '', 'claimed_role': '', 'claimed_at': '', 'claimed_until': ''}}
+        )
+        
+        if not result.matched_count:
+            return jsonify({'error': '未认领该订单'}), 404
+        
+        return jsonify({'success': True})
+        
+    except Exception as e:
+        logger.error(f"释放认领失败: {str(e)}")
+        return jsonify({'error': '释放失败'}), 500
+
+def consume_percentile_test(user_id):
+    """消耗一次排队测试次数，返回 (是否允许, 本次之前已用次数)"""
+    if not redis_client:
+        return True, None
+    
+    test_key = f"percentile_test:{user_id}"
+    test_count = redis_client.get(test_key)
+    if test_count and int(test_count) >= PERCENTILE_TEST_LIMIT:
+        return False, test_count
+    
+    # 增加测试次数
+    redis_client.incr(test_key)
+    redis_client.expire(test_key, 3600)  # 1小时过期
+    return True, test_count
+
+class QueueSnapshot:
+    """活跃队列金额快照：紧急订单数 + 普通订单金额（分）升序数组，用二分查找计算位置"""
+    
+    def __init__(self, emergency_count, amounts_cents):
+        self.emergency_count = emergency_count
+        self.amounts_cents = sorted(amounts_cents)
+        self.built_at = datetime.utcnow()
+    
+    @property
+    def total_queue(self):
+        return self.emergency_count + len(self.amounts_cents)
+    
+    def position_for(self, converted_amount):
+        """给定CAD金额（普通订单）的排队位置"""
+        cents = round(converted_amount * 100)
+        higher_count = len(self.amounts_cents) - bisect.bisect_right(self.amounts_cents, cents)
+        return self.emergency_count + higher_count + 1
+    
+    def min_amount_for_position(self, position):
+        """达到指定位置所需的最低CAD金额；紧急订单已占满该位置之前时返回None"""
+        allowed_ahead = position - 1 - self.emergency_count
+        if allowed_ahead < 0:
+            return None
+        if allowed_ahead >= len(self.amounts_cents):
+            return 0.01
+        # 金额相同不算排在前面，因此与第 allowed_ahead+1 高的金额持平即可
+        return self.amounts_cents[len(self.amounts_cents) - 1 - allowed_ahead] / 100
+
+_queue_snapshot = {'snapshot': None, 'expires_at': 0.0}
+_queue_snapshot_lock = threading.Lock()
+
+def _build_queue_snapshot():
+    """从Redis排队集合（不可用时从MongoDB）构建快照"""
+    if redis_client:
+        try:
+            emergency_count = 0
+            amounts_cents = []
+            for _, score in redis_client.zrange(QUEUE_ZSET_KEY, 0, -1, withscores=True):
+                if score <= queue_score(1, 0):
+                    emergency_count += 1
+                else:
+                    amounts_cents.append(-int(score))
+            return QueueSnapshot(emergency_count, amounts_cents)
+        except Exception as e:
+            logger.warning(f"从Redis构建排队快照失败，回退到数据库: {str(e)}")
+    
+    emergency_count = 0
+    amounts_cents = []
+    for app in db.fortune_applications.find(
+        {'status': {'$in': ACTIVE_QUEUE_STATUSES}},
+        {'_id': 0, 'priority': 1, 'converted_amount_cad': 1}
+    ):
+        if app.get('priority', 0) > 0:
+            emergency_count += 1
+        else:
+            amounts_cents.append(round(app['converted_amount_cad'] * 100))
+    return QueueSnapshot(emergency_count, amounts_cents)
+
+def get_queue_snapshot():
+    """获取短时缓存的排队快照（同一时间只由一个线程重建）"""
+    if _queue_snapshot['snapshot'] and time.monotonic() < _queue_snapshot['expires_at']:
+        return _queue_snapshot['snapshot']
+    with _queue_snapshot_lock:
+        if _queue_snapshot['snapshot'] and time.monotonic() < _queue_snapshot['expires_at']:
+            return _queue_snapshot['snapshot']
+        snapshot = _build_queue_snapshot()
+        _queue_snapshot['snapshot'] = snapshot
+        _queue_snapshot['expires_at'] = time.monotonic() + QUEUE_SNAPSHOT_TTL
+        return snapshot
+
+@app.route('/fortune/percentile/batch', methods=['POST'])
+def get_queue_percentile_batch():
+    """批量测试排队位置，并可反查达到指定位置所需的最低金额（整批只消耗一次测试次数）"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        user_id = user_payload['sub']
+        data = request.get_json(silent=True) or {}
+        queries = data.get('queries', [])
+        target_position = data.get('target_position')
+        target_currency = str(data.get('currency', 'CAD')).upper()
+        
+        if not queries and target_position is None:
+            return jsonify({'error': '缺少必填字段'}), 400
+        
+        if not isinstance(queries, list):
+            return jsonify({'error': 'queries必须是数组'}), 400
+        
+        if len(queries) > PERCENTILE_BATCH_MAX:
+            return jsonify({'error': f'单次最多测试{PERCENTILE_BATCH_MAX}个金额'}), 400
+        
+        # 全部参数校验通过后才消耗测试次数
+        supported_currencies = ['CNY', 'USD', 'CAD', 'SGD', 'AUD']
+        parsed_queries = []
+        for query in queries:
+            if not isinstance(query, dict):
+                return jsonify({'error': '无效的测试项'}), 400
+            currency = str(query.get('currency', 'CAD')).upper()
+            if currency not in supported_currencies:
+                return jsonify({'error': '不支持的币种'}), 400
+            try:
+                amount = float(query.get('amount'))
+            except (TypeError, ValueError):
+                return jsonify({'error': '金额必须是数字'}), 400
+            if not math.isfinite(amount) or amount <= 0:
+                return jsonify({'error': '金额必须大于0'}), 400
+            parsed_queries.append((amount, currency))
+        
+        if target_currency not in supported_currencies:
+            return jsonify({'error': '不支持的币种'}), 400
+        
+        if target_position is not None:
+            try:
+                target_position = int(target_position)
+            except (TypeError, ValueError):
+                return jsonify({'error': '目标位置必须是整数'}), 400
+            if target_position < 1:
+                return jsonify({'error': '目标位置必须大于0'}), 400
+        
+        # 检查测试次数限制
+        allowed, test_count = consume_percentile_test(user_id)
+        if not allowed:
+            return jsonify({'error': '测试次数已用完，请稍后再试'}), 429
+        
+        # 所有金额使用同一份快照计算
+        snapshot = get_queue_snapshot()
+        total_queue = snapshot.total_queue
+        
+        results = []
+        for amount, currency in parsed_queries:
+            converted_amount = convert_to_cad(amount, currency)
+            position = snapshot.position_for(converted_amount)
+            percentile = (position / (total_queue + 1)) * 100 if total_queue > 0 else 0
+            results.append({
+                'amount': amount,
+                'currency': currency,
+                'converted_amount_cad': round(converted_amount, 2),
+                'position': position,
+                'percentile': round(percentile, 1),
+                'eta': throughput_estimator.estimate(position)
+            })
+        
+        response = {
+            'results': results,
+            'total_queue': total_queue + 1,
+            'snapshot_at': snapshot.built_at.isoformat(),
+            'remaining_tests': PERCENTILE_TEST_LIMIT - int(test_count or 0)
+        }
+        
+        if target_position is not None:
+            min_amount_cad = snapshot.min_amount_for_position(target_position)
+            target = {'position': target_position, 'min_amount_cad': None, 'min_amount': None, 'currency': target_currency}
+            if min_amount_cad is not None:
+                rate = get_cached_exchange_rates().get(target_currency, 1.0)
+                # 向上取整到分，保证换算后仍能达到目标位置
+                target['min_amount_cad'] = round(min_amount_cad, 2)
+                target['min_amount'] = math.ceil(min_amount_cad / rate * 100) / 100 if rate else None
+            response['target'] = target
+        
+        return jsonify(response)
+        
+    except Exception as e:
+        logger.error(f"批量计算排队位置失败: {str(e)}")
+        return jsonify({'error': '计算失败'}), 500
+
 @app.route('/fortune/percentile')
 def get_queue_percentile():
     """测试排队位置"""
@@ -617,39 +2100,15 @@ def get_queue_percentile():
         currency = request.args.get('currency', 'CAD').upper()
         
         # 检查测试次数限制
-        test_key = f"percentile_test:{user_id}"
-        test_count = redis_client.get(test_key)
-        if test_count and int(test_count) >= 15:
+        allowed, test_count = consume_percentile_test(user_id)
+        if not allowed:
             return jsonify({'error': '测试次数已用完，请稍后再试'}), 429
         
-        # 增加测试次数
-        redis_client.incr(test_key)
-        redis_client.expire(test_key, 3600)  # 1小时过期
-        
         # 转换为CAD
         converted_amount = convert_to_cad(amount, currency)
         
-        # 计算排队位置
-        # 紧急订单数量
-        emergency_count = db.fortune_applications.count_documents({
-            'status': {'$in': ['Pending', 'Queued-payed', 'Queued-upload']},
-            'kids_emergency': True
-        })
-        
-        # 比当前金额高的非紧急订单数量
-        higher_amount_count = db.fortune_applications.count_documents({
-            'status': {'$in': ['Pending', 'Queued-payed', 'Queued-upload']},
-            'kids_emergency': False,
-            'converted_amount_cad': {'$gt': converted_amount}
-        })
-        
-        # 总队列长度
-        total_queue = db.fortune_applications.count_documents({
-            'status': {'$in': ['Pending', 'Queued-payed', 'Queued-upload']}
-        })
-        
-        # 计算位置（紧急订单 + 高金额订单 + 1）
-        position = emergency_count + higher_amount_count + 1
+        # 计算排队位置：优先使用Redis有序集合（O(log n)），不可用时回退到MongoDB计数
+        position, total_queue = get_queue_position(converted_amount)
         
         # 计算百分比
         if total_queue > 0:
@@ -662,13 +2121,210 @@ def get_queue_percentile():
             'position': position,
             'total_queue': total_queue + 1,
             'converted_amount_cad': round(converted_amount, 2),
-            'remaining_tests': 15 - int(test_count or 0)
+            'remaining_tests': PERCENTILE_TEST_LIMIT - int(test_count or 0),
+            'eta': throughput_estimator.estimate(position)
         })
         
     except Exception as e:
         logger.error(f"计算排队位置失败: {str(e)}")
         return jsonify({'error': '计算失败'}), 500
 
+def get_queue_position(converted_amount):
+    """计算给定CAD金额（非紧急订单）的排队位置，返回 (位置, 当前队列长度)"""
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            # 分数严格小于该金额分数的成员：所有紧急订单 + 金额更高的普通订单
+            pipe.zcount(QUEUE_ZSET_KEY, '-inf', f"({queue_score(0, converted_amount)}")
+            pipe.zcard(QUEUE_ZSET_KEY)
+            ahead_count, total_queue = pipe.execute()
+            return ahead_count + 1, total_queue
+        except Exception as e:
+            logger.warning(f"Redis排队查询失败，回退到数据库: {str(e)}")
+    
+    # 紧急订单数量
+    emergency_count = db.fortune_applications.count_documents({
+        'status': {'$in': ACTIVE_QUEUE_STATUSES},
+        'kids_emergency': True
+    })
+    
+    # 比当前金额高的非紧急订单数量
+    higher_amount_count = db.fortune_applications.count_documents({
+        'status': {'$in': ACTIVE_QUEUE_STATUSES},
+        'kids_emergency': False,
+        'converted_amount_cad': {'$gt': converted_amount}
+    })
+    
+    # 总队列长度
+    total_queue = db.fortune_applications.count_documents({
+        'status': {'$in': ACTIVE_QUEUE_STATUSES}
+    })
+    
+    # 计算位置（紧急订单 + 高金额订单 + 1）
+    return emergency_count + higher_amount_count + 1, total_queue
+
+@app.route('/fortune/stats')
+def get_master_fortune_stats():
+    """获取算命订单统计（Master面板）"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        if user_payload.get('role', 'user') not in ['Master', 'Firstmate', 'admin']:
+            return jsonify({'error': '无权限'}), 403
+        
+        stats = get_fortune_stats()
+        return jsonify({
+            'total_orders': stats['total_orders'],
+            'total_revenue': stats['total_revenue'],
+            'completed_orders': stats['completed_orders'],
+            'pending_orders': stats['pending_orders'],
+            'queued_orders': stats['queued_orders'],
+            'currency': stats['currency'],
+            'updated_at': stats['updated_at']
+        })
+        
+    except Exception as e:
+        logger.error(f"获取统计数据失败: {str(e)}")
+        return jsonify({'error': '获取统计失败'}), 500
+
+@app.route('/fortune/admin/stats')
+def get_admin_fortune_stats():
+    """获取完整算命订单统计（按状态和币种）"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        if user_payload.get('role', 'user') not in ['Master', 'Firstmate', 'admin']:
+            return jsonify({'error': '无权限'}), 403
+        
+        return jsonify(get_fortune_stats())
+        
+    except Exception as e:
+        logger.error(f"获取统计数据失败: {str(e)}")
+        return jsonify({'error': '获取统计失败'}), 500
+
+def export_row(app):
+    """将申请文档转换为导出行"""
+    def iso(value):
+        return value.isoformat() if value else None
+    
+    return {
+        'order_id': str(app['_id']),
+        'user_id': app.get('user_id'),
+        'user_email': app.get('user_email'),
+        'amount': app.get('amount'),
+        'currency': app.get('currency'),
+        'converted_amount_cad': app.get('converted_amount_cad'),
+        'kids_emergency': app.get('kids_emergency', False),
+        'priority': app.get('priority'),
+        'status': app.get('status'),
+        'created_at': iso(app.get('created_at')),
+        'updated_at': iso(app.get('updated_at')),
+        'completed_at': iso((app.get('reply') or {}).get('timestamp'))
+    }
+
+def parse_export_date(value, end_of_day=False):
+    """解析导出日期参数（YYYY-MM-DD 或 ISO时间），纯日期作为结束时间时包含当天"""
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+@app.route('/fortune/admin/export')
+def export_fortune_applications():
+    """流式导出算命申请（CSV或NDJSON），内存占用与数据量无关
+    
+    参数：format=csv|ndjson，status=逗号分隔的状态，from/to=创建日期范围
+    """
+    user_payload = verify_token()
+    if not user_payload:
+        return jsonify({'error': '未登录'}), 401
+    
+    if user_payload.get('role', 'user') not in ['Master', 'Firstmate', 'admin']:
+        return jsonify({'error': '无权限'}), 403
+    
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ['csv', 'ndjson']:
+        return jsonify({'error': '不支持的导出格式'}), 400
+    
+    query = {}
+    status_filter = request.args.get('status')
+    if status_filter:
+        query['status'] = {'$in': [status.strip() for status in status_filter.split(',') if status.strip()]}
+    
+    try:
+        created_range = {}
+        if request.args.get('from'):
+            created_range['$gte'] = parse_export_date(request.args['from'])
+        if request.args.get('to'):
+            created_range['$lt'] = parse_export_date(request.args['to'], end_of_day=True)
+    except ValueError:
+        return jsonify({'error': '无效的日期格式'}), 400
+    if created_range:
+        query['created_at'] = created_range
+    
+    cursor = (db.fortune_applications.find(query, EXPORT_PROJECTION)
+              .sort(EXPORT_SORT)
+              .batch_size(EXPORT_BATCH_SIZE))
+    
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for app in cursor:
+            writer.writerow(export_row(app))
+            # 攒够64KB再输出，避免逐行产生过多小块
+            if buffer.tell() >= 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    def generate_ndjson():
+        for app in cursor:
+            yield json.dumps(export_row(app), ensure_ascii=False) + '\n'
+    
+    def generate():
+        try:
+            yield from (generate_csv() if export_format == 'csv' else generate_ndjson())
+        except Exception as e:
+            logger.error(f"导出算命申请失败: {str(e)}")
+            raise
+        finally:
+            cursor.close()
+    
+    filename = f"fortune_applications_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson',
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@app.route('/fortune/user/<user_id>/stats')
+def get_user_fortune_stats(user_id):
+    """获取单个用户的算命订单统计"""
+    try:
+        user_payload = verify_token()
+        if not user_payload:
+            return jsonify({'error': '未登录'}), 401
+        
+        # 普通用户只能看自己的统计
+        if user_payload['sub'] != user_id and user_payload.get('role', 'user') not in ['Master', 'Firstmate', 'admin']:
+            return jsonify({'error': '无权限'}), 403
+        
+        return jsonify(get_fortune_stats(f'user:{user_id}'))
+        
+    except Exception as e:
+        logger.error(f"获取用户统计数据失败: {str(e)}")
+        return jsonify({'error': '获取统计失败'}), 500
+
 @app.route('/fortune/update-status', methods=['POST'])
 def update_payment_status():
     """更新支付状态（内部接口）"""
@@ -685,29 +2341,14 @@ def update_payment_status():
         if not order_id or not status:
             return jsonify({'error': '缺少必填字段'}), 400
         
-        # 验证订单存在且状态为Pending
-        application = db.fortune_applications.find_one({
-            '_id': ObjectId(order_id),
-            'status': 'Pending'
-        })
+        if status not in STATUS_TRANSITIONS['Pending']:
+            return jsonify({'error': '不支持的状态'}), 400
         
+        # 仅当订单状态为Pending时更新（校验与更新在同一次请求中完成）
+        application = transition_application(order_id, status)
         if not application:
             return jsonify({'error': '订单不存在或状态不正确'}), 404
         
-        # 更新状态
-        db.fortune_applications.update_one(
-            {'_id': ObjectId(order_id)},
-            {
-                '$set': {
-                    'status': status,
-                    'updated_at': datetime.utcnow()
-                }
-            }
-        )
-        
-        # 触发WebSocket通知（如果需要）
-        # socketio.emit('status_update', {'order_id': order_id, 'status': status})
-        
         logger.info(f"订单 {order_id} 状态更新为: {status}")
         
         return jsonify({'success': True})
@@ -736,37 +2377,28 @@ def upload_payment_proof():
         if len(screenshots) > 3:
             return jsonify({'error': '最多只能上传3张截图'}), 400
         
-        # 验证订单
-        application = db.fortune_applications.find_one({
-            '_id': ObjectId(order_id),
-            'user_id': user_id,
-            'status': 'Pending'
-        })
-        
-        if not application:
+        # 上传前先确认订单属于本人且待支付，避免为无效订单写入R2对象
+        if not ObjectId.is_valid(order_id) or not db.fortune_applications.find_one(
+            {'_id': ObjectId(order_id), 'user_id': user_id, 'status': 'Pending'}, {'_id': 1}
+        ):
             return jsonify({'error': '订单不存在或状态不正确'}), 404
         
         # 上传截图
-        uploaded_screenshots = []
-        for i, screenshot_data in enumerate(screenshots):
-            try:
-                filename = f"payment_proof_{i+1}.jpg"
-                image_info = upload_image_to_r2(screenshot_data, filename)
-                uploaded_screenshots.append(image_info)
-            except Exception as e:
-                return jsonify({'error': f'截图上传失败: {str(e)}'}), 400
+        try:
+            uploaded_screenshots = upload_images_to_r2(screenshots, 'payment_proof')
+        except Exception as e:
+            return jsonify({'error': f'截图上传失败: {str(e)}'}), 400
         
-        # 更新订单状态
-        db.fortune_applications.update_one(
-            {'_id': ObjectId(order_id)},
-            {
-                '$set': {
-                    'status': 'Queued-upload',
-                    'payment_screenshots': uploaded_screenshots,
-                    'updated_at': datetime.utcnow()
-                }
-            }
+        # 更新订单状态（仅本人且状态为Pending的订单，条件更新防止并发状态变化）
+        application = transition_application(
+            order_id, 'Queued-upload',
+            query={'user_id': user_id},
+            updates={'payment_screenshots': uploaded_screenshots}
         )
+        if not application:
+            return jsonify({'error': '订单不存在或状态不正确'}), 404
+        
+        schedule_image_derivatives(order_id, 'payment_screenshots', uploaded_screenshots)
         
         logger.info(f"用户 {user_id} 上传支付凭证: {order_id}")
         
@@ -776,11 +2408,46 @@ def upload_payment_proof():
         logger.error(f"上传支付凭证失败: {str(e)}")
         return jsonify({'error': '上传失败'}), 500
 
+@app.route('/fortune/events')
+def stream_fortune_events():
+    """实时事件流（SSE）：普通用户接收自己申请的事件，Master/Firstmate接收全部事件"""
+    user_payload = verify_token()
+    if not user_payload:
+        return jsonify({'error': '未登录'}), 401
+    
+    if user_payload.get('role', 'user') in ['Master', 'Firstmate', 'admin']:
+        channels = ['master']
+    else:
+        channels = [f"user:{user_payload['sub']}"]
+    
+    subscriber = fortune_events.subscribe(channels)
+    
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    message = subscriber.get(timeout=EVENT_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # 心跳，保持连接并及时发现断开的客户端
+                    yield ': ping\n\n'
+                    continue
+                event = json.loads(message)
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            fortune_events.unsubscribe(subscriber, channels)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/fortune/exchange-rates', methods=['GET'])
 def get_current_exchange_rates():
     """获取当前汇率"""
     try:
-        rates = get_exchange_rates()
+        rates = get_cached_exchange_rates()
         return jsonify({
             'rates': rates,
             'base_currency': 'CAD',
@@ -799,7 +2466,8 @@ def force_update_exchange_rates():
         if internal_key != INTERNAL_API_KEY:
             return jsonify({'error': '无权限访问'}), 403
         
-        rates = get_exchange_rates()
+        invalidate_exchange_rate_cache()
+        rates = get_cached_exchange_rates()
         if rates:
             return jsonify({
                 'success': True,
@@ -831,8 +2499,11 @@ def handle_exchange_rates_updated():
         
         logger.info(f"收到汇率更新通知: {rates}")
         
+        # 立即刷新进程内汇率缓存
+        invalidate_exchange_rate_cache(rates)
+        
         # 触发队列索引重新计算（因为汇率变化可能影响排序）
-        threading.Thread(target=update_queue_indexes).start()
+        queue_reindex_scheduler.trigger()
         
         # 可以在这里添加其他需要在汇率更新后执行的逻辑
         # 比如通知前端、更新相关缓存等
@@ -843,26 +2514,335 @@ def handle_exchange_rates_updated():
         logger.error(f"处理汇率更新通知失败: {str(e)}")
         return jsonify({'error': '处理失败'}), 500
 
+@app.route('/fortune/metrics')
+def get_service_metrics():
+    """获取服务内部指标（内部接口）"""
+    try:
+        # 验证内部调用
+        internal_key = request.headers.get('X-Internal-Key')
+        if internal_key != INTERNAL_API_KEY:
+            return jsonify({'error': '无权限访问'}), 403
+        
+        return jsonify({
+            'queue_reindex': queue_reindex_scheduler.metrics(),
+            'notification_outbox': notification_dispatcher.metrics(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"获取服务指标失败: {str(e)}")
+        return jsonify({'error': '获取指标失败'}), 500
+
+@app.route('/fortune/indexes')
+def get_index_report():
+    """获取启动时的索引检查报告（内部接口）"""
+    # 验证内部调用
+    internal_key = request.headers.get('X-Internal-Key')
+    if internal_key != INTERNAL_API_KEY:
+        return jsonify({'error': '无权限访问'}), 403
+    
+    return jsonify({'indexes': index_report})
+
+@app.route('/fortune/reindex-queue', methods=['POST'])
+def reindex_queue():
+    """手动重排队列索引（内部接口）"""
+    try:
+        # 验证内部调用
+        internal_key = request.headers.get('X-Internal-Key')
+        if internal_key != INTERNAL_API_KEY:
+            return jsonify({'error': '无权限访问'}), 403
+        
+        data = request.get_json(silent=True) or {}
+        mode = data.get('mode')
+        if mode and mode not in ['bulk', 'server']:
+            return jsonify({'error': '不支持的重排模式'}), 400
+        
+        stats = update_queue_indexes(mode)
+        if not stats:
+            return jsonify({'error': '重排失败'}), 500
+        
+        return jsonify({'success': True, **stats})
+        
+    except Exception as e:
+        logger.error(f"手动重排队列失败: {str(e)}")
+        return jsonify({'error': '重排失败'}), 500
+
+def _reindex_queue_bulk():
+    """在Python中计算排名，仅将发生变化的queue_index通过一次bulk_write写回"""
+    cursor = db.fortune_applications.find(
+        {'status': {'$in': ACTIVE_QUEUE_STATUSES}},
+        {'_id': 1, 'queue_index': 1, 'user_id': 1}
+    ).sort(QUEUE_SORT)
+    
+    operations = []
+    changes = []
+    matched = 0
+    for index, app in enumerate(cursor, 1):
+        matched += 1
+        if app.get('queue_index') != index:
+            operations.append(pymongo.UpdateOne({'_id': app['_id']}, {'$set': {'queue_index': index}}))
+            changes.append((app['user_id'], str(app['_id']), index))
+    
+    modified = 0
+    if operations:
+        result = db.fortune_applications.bulk_write(operations, ordered=False)
+        modified = result.modified_count
+        
+        publish_queue_index_changes(changes)
+    
+    return matched, modified
+
+def publish_queue_index_changes(changes):
+    """只向排队位置变化的用户推送，所有事件一次管道发送"""
+    fortune_events.publish_many([
+        (f'user:{user_id}', 'queue_index', {'order_id': order_id, 'queue_index': index})
+        for user_id, order_id, index in changes
+    ])
+
+def _reindex_queue_server():
+    """在MongoDB内计算排名（$setWindowFields），只取回排名变化的申请写回并推送"""
+    matched = db.fortune_applications.count_documents({'status': {'$in': ACTIVE_QUEUE_STATUSES}})
+    changed = list(db.fortune_applications.aggregate([
+        {'$match': {'status': {'$in': ACTIVE_QUEUE_STATUSES}}},
+        {'$setWindowFields': {
+            'sortBy': dict(QUEUE_SORT),
+            'output': {'new_index': {'$documentNumber': {}}}
+        }},
+        {'$match': {'$expr': {'$ne': ['$queue_index', '$new_index']}}},
+        {'$project': {'user_id': 1, 'new_index': 1}}
+    ]))
+    
+    modified = 0
+    if changed:
+        result = db.fortune_applications.bulk_write([
+            pymongo.UpdateOne({'_id': app['_id']}, {'$set': {'queue_index': app['new_index']}})
+            for app in changed
+        ], ordered=False)
+        modified = result.modified_count
+        publish_queue_index_changes([(app['user_id'], str(app['_id']), app['new_index']) for app in changed])
+    
+    return matched, modified
+
 # 定时任务：更新队列索引（每2小时执行一次）
-def update_queue_indexes():
-    """更新队列索引"""
+def update_queue_indexes(mode=None):
+    """更新队列索引，返回本次重排的统计信息"""
+    mode = mode or QUEUE_REINDEX_MODE
+    started = time.monotonic()
     try:
-        # 按优先级和金额排序获取所有待处理申请
-        applications = list(db.fortune_applications.find({
-            'status': {'$in': ['Pending', 'Queued-payed', 'Queued-upload']}
-        }).sort([('priority', -1), ('converted_amount_cad', -1), ('created_at', 1)]))
+        if mode == 'server':
+            matched, modified = _reindex_queue_server()
+        else:
+            mode = 'bulk'
+            matched, modified = _reindex_queue_bulk()
         
-        # 更新队列索引
-        for index, app in enumerate(applications, 1):
-            db.fortune_applications.update_one(
-                {'_id': app['_id']},
-                {'$set': {'queue_index': index}}
-            )
+        elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+        fortune_events.publish('master', 'queue_reindexed', {'mode': mode, 'matched': matched, 'modified': modified})
+        logger.info(f"队列索引更新完成（{mode}），共 {matched} 个申请，更新 {modified} 条，耗时 {elapsed_ms}ms")
         
-        logger.info(f"队列索引更新完成，共 {len(applications)} 个申请")
+        return {
+            'mode': mode,
+            'matched': matched,
+            'modified': modified,
+            'elapsed_ms': elapsed_ms
+        }
         
     except Exception as e:
         logger.error(f"更新队列索引失败: {str(e)}")
+        return None
+
+class QueueReindexScheduler:
+    """队列重排调度器：每个进程一个后台线程，多次触发合并为一次重排
+    
+    触发只设置脏标记；工作线程在防抖窗口结束后执行一次重排。重排进行中
+    到达的触发只会再排队一次，因此任意时刻最多一个重排在执行、一个在等待。
+    """
+    
+    def __init__(self, debounce_seconds=QUEUE_REINDEX_DEBOUNCE):
+        self.debounce_seconds = debounce_seconds
+        self.condition = threading.Condition()
+        self.dirty = False
+        self.running = False
+        self.thread = None
+        self.triggers_received = 0
+        self.reindexes_executed = 0
+        self.reindexes_failed = 0
+        self.last_stats = None
+        self.last_run_at = None
+    
+    def trigger(self):
+        """标记队列需要重排（O(1)，不阻塞请求线程）"""
+        with self.condition:
+            self.triggers_received += 1
+            self.dirty = True
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='queue-reindex', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+    
+    def _run(self):
+        """工作线程主循环"""
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+            
+            # 防抖：等待窗口内的其他触发一起合并
+            time.sleep(self.debounce_seconds)
+            
+            with self.condition:
+                self.dirty = False
+                self.running = True
+            
+            stats = update_queue_indexes()
+            
+            with self.condition:
+                self.running = False
+                self.last_run_at = datetime.utcnow()
+                if stats:
+                    self.reindexes_executed += 1
+                    self.last_stats = stats
+                else:
+                    self.reindexes_failed += 1
+    
+    def metrics(self):
+        """返回调度器指标"""
+        with self.condition:
+            executed = self.reindexes_executed + self.reindexes_failed
+            return {
+                'triggers_received': self.triggers_received,
+                'reindexes_executed': self.reindexes_executed,
+                'reindexes_failed': self.reindexes_failed,
+                'triggers_coalesced': max(self.triggers_received - executed - int(self.dirty) - int(self.running), 0),
+                'pending': self.dirty,
+                'running': self.running,
+                'debounce_seconds': self.debounce_seconds,
+                'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+                'last_stats': self.last_stats
+            }
+
+queue_reindex_scheduler = QueueReindexScheduler()
+
+# 启动时确保的索引及其覆盖的查询形态
+FORTUNE_INDEXES = [
+    {
+        'collection': 'fortune_applications',
+        'name': 'status_queue_order',
+        'keys': [('status', 1)] + LIST_SORT,
+        'covers': [
+            '/fortune/list 按status筛选并按队列顺序排序（Master面板）',
+            'update_queue_indexes / rebuild_queue_zset 活跃队列扫描',
+            '/fortune/claim-next 按队列顺序认领下一个订单'
+        ]
+    },
+    {
+        'collection': 'fortune_applications',
+        'name': 'user_queue_order',
+        'keys': [('user_id', 1)] + LIST_SORT,
+        'covers': [
+            '/fortune/list 普通用户查看自己的申请',
+            '/fortune/modify、/fortune/upload 的 {_id, user_id, status} 校验（_id索引定位，user_id前缀备用）'
+        ]
+    },
+    {
+        'collection': 'fortune_applications',
+        'name': 'queue_order',
+        'keys': LIST_SORT,
+        'covers': ['/fortune/list 无筛选的全部申请（含游标分页）']
+    },
+    {
+        'collection': 'fortune_applications',
+        'name': 'status_emergency_amount',
+        'keys': [('status', 1), ('kids_emergency', 1), ('converted_amount_cad', -1)],
+        'covers': ['/fortune/percentile 在Redis不可用时的 {status, kids_emergency, converted_amount_cad} 计数']
+    },
+    {
+        'collection': 'fortune_applications',
+        'name': 'created_at',
+        'keys': EXPORT_SORT,
+        'covers': ['/fortune/admin/export 按创建时间范围流式导出']
+    },
+    {
+        'collection': 'fortune_modifications',
+        'name': 'application_timestamp',
+        'keys': [('application_id', 1), ('timestamp', 1)],
+        'covers': ['/fortune/applications/<order_id> 修改历史']
+    },
+    {
+        'collection': 'fortune_images',
+        'name': 'etag',
+        'keys': [('etag', 1)],
+        'options': {'sparse': True},
+        'covers': ['直传图片按ETag去重查找']
+    },
+    {
+        'collection': 'fortune_images',
+        'name': 'key',
+        'keys': [('key', 1)],
+        'covers': ['直传图片按对象key复用已有索引记录']
+    },
+    {
+        'collection': 'notification_outbox',
+        'name': 'status_next_attempt',
+        'keys': [('status', 1), ('next_attempt_at', 1)],
+        'covers': ['通知发件箱领取到期通知及队列深度统计']
+    },
+    {
+        'collection': 'notification_outbox',
+        'name': 'claim_id',
+        'keys': [('claim_id', 1)],
+        'options': {'sparse': True},
+        'covers': ['通知发件箱按claim_id读取本次领取的通知']
+    },
+    {
+        'collection': 'notification_outbox',
+        'name': 'sent_at_ttl',
+        'keys': [('sent_at', 1)],
+        'options': {'expireAfterSeconds': 7 * 24 * 60 * 60},
+        'covers': ['已发送通知保留7天后自动清理']
+    },
+    {
+        'collection': 'exchange_rates',
+        'name': 'created_at_desc',
+        'keys': [('created_at', -1)],
+        'covers': ['get_exchange_rates 最新汇率查询']
+    }
+]
+
+# 最近一次索引检查报告
+index_report = []
+
+def ensure_indexes():
+    """幂等地创建所需索引，返回每个索引的状态及其覆盖的查询形态"""
+    report = []
+    existing_by_collection = {}
+    for spec in FORTUNE_INDEXES:
+        collection = db[spec['collection']]
+        entry = {
+            'collection': spec['collection'],
+            'name': spec['name'],
+            'keys': [[field, direction] for field, direction in spec['keys']],
+            'covers': spec['covers']
+        }
+        try:
+            if spec['collection'] not in existing_by_collection:
+                existing_by_collection[spec['collection']] = collection.index_information()
+            existing = existing_by_collection[spec['collection']]
+            
+            if spec['name'] in existing:
+                entry['status'] = 'exists'
+            else:
+                collection.create_index(spec['keys'], name=spec['name'], **spec.get('options', {}))
+                entry['status'] = 'created'
+        except Exception as e:
+            entry['status'] = 'error'
+            entry['error'] = str(e)
+            logger.error(f"创建索引失败 {spec['collection']}.{spec['name']}: {str(e)}")
+        report.append(entry)
+    
+    index_report[:] = report
+    for entry in report:
+        logger.info(f"索引 {entry['collection']}.{entry['name']} [{entry['status']}] 覆盖: {'; '.join(entry['covers'])}")
+    return report
 
 # 定时任务：每周更新汇率
 def weekly_exchange_rate_update():
@@ -870,7 +2850,7 @@ def weekly_exchange_rate_update():
     while True:
         try:
             time.sleep(7 * 24 * 60 * 60)  # 7天
-            get_exchange_rates()
+            invalidate_exchange_rate_cache(get_exchange_rates())
         except Exception as e:
             logger.error(f"定时汇率更新失败: {str(e)}")
 
@@ -881,17 +2861,25 @@ def start_background_tasks():
     exchange_thread = threading.Thread(target=weekly_exchange_rate_update, daemon=True)
     exchange_thread.start()
     
+    # 初始化排队有序集合
+    threading.Thread(target=rebuild_queue_zset, daemon=True).start()
+    threading.Thread(target=throughput_estimator.seed_from_database, daemon=True).start()
+    
     # 队列索引更新线程
     def queue_update_loop():
         while True:
             try:
                 time.sleep(2 * 60 * 60)  # 2小时
-                update_queue_indexes()
+                queue_reindex_scheduler.trigger()
+                rebuild_queue_zset()
             except Exception as e:
                 logger.error(f"定时队列更新失败: {str(e)}")
     
     queue_thread = threading.Thread(target=queue_update_loop, daemon=True)
     queue_thread.start()
+    
+    # 通知发件箱分发线程（处理重启前未发送的通知）
+    notification_dispatcher.start()
 
 # Webhook验证和审计函数
 def verify_webhook_signature(payload, signature, secret):
@@ -910,48 +2898,221 @@ def verify_webhook_signature(payload, signature, secret):
     return hmac.compare_digest(signature, expected_signature)
 
 def send_audit_log(event_type, user_id, action, details=None):
-    """发送审计日志到外部系统"""
+    """发送审计日志到外部系统（写入发件箱，由后台分发线程发送）"""
     if not AUDIT_WEBHOOK_URL:
         return
     
+    enqueue_notification('audit', {
+        'event_type': event_type,
+        'user_id': user_id,
+        'action': action,
+        'details': details or {},
+        'timestamp': datetime.utcnow().isoformat(),
+        'service': 'fortune-service'
+    })
+
+def _deliver_audit_log(audit_data):
+    """实际发送审计日志"""
+    # 生成签名
+    payload = json.dumps(audit_data, separators=(',', ':'))
+    signature = hmac.new(
+        WEBHOOK_SECRET.encode('utf-8'),
+        payload.encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+    
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Webhook-Signature': signature
+    }
+    
+    response = requests.post(AUDIT_WEBHOOK_URL, 
+                           data=payload, 
+                           headers=headers, 
+                           timeout=5)
+    
+    if response.status_code == 200:
+        logger.info(f"审计日志发送成功: {audit_data.get('event_type')}")
+    elif 400 <= response.status_code < 500:
+        raise NotificationRejected(f"审计端点拒绝: {response.status_code}")
+    else:
+        raise RuntimeError(f"审计日志发送失败: {response.status_code}")
+
+# 通知发件箱：请求线程只插入一条记录，由后台线程批量发送、失败重试并指数退避
+class NotificationRejected(Exception):
+    """对方明确拒绝（4xx），不再重试"""
+
+NOTIFICATION_HANDLERS = {
+    'email': _deliver_email_notification,
+    'audit': _deliver_audit_log
+}
+
+def enqueue_notification(kind, payload):
+    """将通知写入发件箱（notification_outbox集合）"""
     try:
-        audit_data = {
-            'event_type': event_type,
-            'user_id': user_id,
-            'action': action,
-            'details': details or {},
-            'timestamp': datetime.utcnow().isoformat(),
-            'service': 'fortune-service'
-        }
-        
-        # 生成签名
-        payload = json.dumps(audit_data, separators=(',', ':'))
-        signature = hmac.new(
-            WEBHOOK_SECRET.encode('utf-8'),
-            payload.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Webhook-Signature': signature
-        }
-        
-        response = requests.post(AUDIT_WEBHOOK_URL, 
-                               data=payload, 
-                               headers=headers, 
-                               timeout=5)
-        
-        if response.status_code == 200:
-            logger.info(f"审计日志发送成功: {event_type}")
-        else:
-            logger.warning(f"审计日志发送失败: {response.status_code}")
-            
+        now = datetime.utcnow()
+        db.notification_outbox.insert_one({
+            'kind': kind,
+            'payload': payload,
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now
+        })
+        notification_dispatcher.wake()
     except Exception as e:
-        logger.error(f"发送审计日志失败: {str(e)}")
+        logger.error(f"写入通知发件箱失败: {str(e)}")
 
-if __name__ == '__main__':
+class NotificationDispatcher:
+    """发件箱分发器：每个进程一个后台线程"""
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.last_latency_ms = None
+        self.max_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+    
+    def start(self):
+        """启动分发线程（幂等）"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='notification-outbox', daemon=True)
+                self.thread.start()
+    
+    def wake(self):
+        """有新通知时唤醒分发线程"""
+        self.start()
+        self.event.set()
+    
+    def _run(self):
+        """分发线程主循环"""
+        while True:
+            try:
+                dispatched = self.dispatch_batch()
+            except Exception as e:
+                logger.error(f"通知分发失败: {str(e)}")
+                dispatched = 0
+            
+            # 本批已满时立即处理下一批，否则等待唤醒或轮询
+            if dispatched < OUTBOX_BATCH_SIZE:
+                self.event.wait(OUTBOX_POLL_INTERVAL)
+                self.event.clear()
+    
+    def _claim_batch(self):
+        """领取一批到期的通知（包括租约已过期的发送中通知）
+        
+        更新条件中重复到期判断，并用唯一的claim_id标记本次领取，多个发送进程
+        同时读到同一批候选时，每条通知只会被其中一个领取到。
+        """
+        now = datetime.utcnow()
+        due = {'$or': [
+            {'status': 'pending', 'next_attempt_at': {'$lte': now}},
+            {'status': 'sending', 'lease_until': {'$lte': now}}
+        ]}
+        candidates = list(db.notification_outbox.find(due, {'_id': 1})
+                          .sort('next_attempt_at', 1).limit(OUTBOX_BATCH_SIZE))
+        if not candidates:
+            return []
+        
+        claim_id = uuid.uuid4().hex
+        db.notification_outbox.update_many(
+            {'$and': [{'_id': {'$in': [doc['_id'] for doc in candidates]}}, due]},
+            {'$set': {
+                'status': 'sending',
+                'claim_id': claim_id,
+                'lease_until': now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+            }}
+        )
+        return list(db.notification_outbox.find({'claim_id': claim_id}))
+    
+    def dispatch_batch(self):
+        """发送一批通知并批量写回结果，返回本批处理数量"""
+        batch = self._claim_batch()
+        if not batch:
+            return 0
+        
+        operations = []
+        for notification in batch:
+            now = datetime.utcnow()
+            try:
+                handler = NOTIFICATION_HANDLERS[notification['kind']]
+                handler(notification['payload'])
+                operations.append(pymongo.UpdateOne(
+                    {'_id': notification['_id'], 'claim_id': notification['claim_id']},
+                    {'$set': {'status': 'sent', 'sent_at': now}, '$unset': {'lease_until': '', 'claim_id': ''}}
+                ))
+                latency_ms = (now - notification['created_at']).total_seconds() * 1000
+                with self.lock:
+                    self.sent += 1
+                    self.last_latency_ms = round(latency_ms, 1)
+                    self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+                    self.total_latency_ms += latency_ms
+            except Exception as e:
+                attempts = notification.get('attempts', 0) + 1
+                permanent = isinstance(e, (NotificationRejected, KeyError)) or attempts >= OUTBOX_MAX_ATTEMPTS
+                update = {
+                    'attempts': attempts,
+                    'last_error': str(e),
+                    'status': 'failed' if permanent else 'pending'
+                }
+                if not permanent:
+                    # 指数退避：5秒、10秒、20秒……最长1小时
+                    update['next_attempt_at'] = now + timedelta(seconds=min(5 * 2 ** (attempts - 1), 3600))
+                operations.append(pymongo.UpdateOne(
+                    {'_id': notification['_id'], 'claim_id': notification['claim_id']},
+                    {'$set': update, '$unset': {'lease_until': '', 'claim_id': ''}}
+                ))
+                with self.lock:
+                    if permanent:
+                        self.failed += 1
+                    else:
+                        self.retried += 1
+                logger.warning(f"通知发送失败（第{attempts}次）{notification['kind']}: {str(e)}")
+        
+        db.notification_outbox.bulk_write(operations, ordered=False)
+        with self.lock:
+            self.batches += 1
+        return len(batch)
+    
+    def metrics(self):
+        """返回发件箱指标"""
+        try:
+            depth = db.notification_outbox.count_documents({'status': {'$in': ['pending', 'sending']}})
+            oldest = db.notification_outbox.find_one(
+                {'status': 'pending'}, {'created_at': 1}, sort=[('created_at', 1)]
+            )
+        except Exception as e:
+            logger.warning(f"读取发件箱深度失败: {str(e)}")
+            depth, oldest = None, None
+        
+        with self.lock:
+            return {
+                'queue_depth': depth,
+                'oldest_pending_age_seconds': round((datetime.utcnow() - oldest['created_at']).total_seconds(), 1) if oldest else 0,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'batches': self.batches,
+                'last_dispatch_latency_ms': self.last_latency_ms,
+                'avg_dispatch_latency_ms': round(self.total_latency_ms / self.sent, 1) if self.sent else None,
+                'max_dispatch_latency_ms': round(self.max_latency_ms, 1)
+            }
+
+notification_dispatcher = NotificationDispatcher()
+
+def main():
+    """服务入口，由 main.py 调用（app.py 不作为 __main__ 运行）"""
+    # 确保数据库索引
+    ensure_indexes()
+    ensure_fortune_stats()
+    
     # 启动后台任务
     start_background_tasks()
     
-    app.run(host='0.0.0.0', port=5007, debug=False) 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5007, debug=False)
@@ -0,0 +1,66 @@
+"""
+图片衍生图生成模块
+在独立进程中执行CPU密集的解码、缩放和重新编码，生成缩略图及多尺寸WebP/AVIF版本
+"""
+
+import io
+from typing import Dict, Tuple
+from PIL import Image
+
+# 缩略图尺寸（与原有缩略图保持一致）
+THUMBNAIL_SIZE = (300, 300)
+
+# 衍生图宽度（像素），不超过原图尺寸
+VARIANT_WIDTHS = (480, 960, 1600)
+
+
+def supported_variant_formats():
+    """返回当前Pillow可编码的衍生图格式（AVIF需要额外插件）"""
+    Image.init()
+    formats = ['WEBP']
+    if 'AVIF' in Image.SAVE:
+        formats.append('AVIF')
+    return formats
+
+
+def _encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == 'JPEG':
+        image.save(buffer, format='JPEG', quality=85)
+    else:
+        image.save(buffer, format=image_format, quality=80)
+    return buffer.getvalue()
+
+
+def generate_image_derivatives(image_bytes: bytes) -> Dict[str, Tuple[bytes, str]]:
+    """
+    生成图片衍生图
+
+    Args:
+        image_bytes: 原图字节
+
+    Returns:
+        {名称: (字节, Content-Type)}，名称如 thumbnail、w960.webp
+    """
+    source = Image.open(io.BytesIO(image_bytes))
+    source.load()
+    if source.mode not in ('RGB', 'L'):
+        source = source.convert('RGB')
+
+    derivatives = {}
+
+    thumbnail = source.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    derivatives['thumbnail'] = (_encode(thumbnail, 'JPEG'), 'image/jpeg')
+
+    formats = supported_variant_formats()
+    for width in VARIANT_WIDTHS:
+        if width >= source.width and width != VARIANT_WIDTHS[0]:
+            break
+        resized = source.copy()
+        resized.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+        for image_format in formats:
+            extension = image_format.lower()
+            derivatives[f"w{width}.{extension}"] = (_encode(resized, image_format), f"image/{extension}")
+
+    return derivatives
@@ -0,0 +1,12 @@
+"""
+算命服务启动入口
+
+衍生图进程池使用forkserver/spawn启动工作进程，会以 __mp_main__ 重新导入主模块。
+app.py 在模块级创建Mongo、Redis和R2客户端及线程池，因此不直接作为 __main__ 运行，
+只在此处的 __main__ 分支中导入，工作进程重新导入本文件时不会执行这些初始化。
+"""
+
+if __name__ == '__main__':
+    import app
+
+    app.main()
@@ -4,7 +4,7 @@ import type { RequestHandler } from '@sveltejs/kit';
 // 使用统一的API网关域名
 const apiBaseUrl = 'https://api.baidaohui.com';
 
-export const GET: RequestHandler = async ({ fetch, cookies }) => {
+export const GET: RequestHandler = async ({ fetch, cookies, url }) => {
   try {
     // 获取认证token
     const token = cookies.get('access_token');
@@ -16,7 +16,7 @@ export const GET: RequestHandler = async ({ fetch, cookies }) => {
     const controller = new AbortController();
     const timeoutId = setTimeout(() => controller.abort(), 8000);
     
-    const response = await fetch(`${apiBaseUrl}/chat/api/chat/members`, {
+    const response = await fetch(`${apiBaseUrl}/chat/api/chat/members${url.search}`, {
       headers: {
         'Authorization': `Bearer ${token}`,
         'Content-Type': 'application/json'
@@ -32,7 +32,14 @@ export const GET: RequestHandler = async ({ fetch, cookies }) => {
     }
 
     const result = await response.json();
-    return json(result);
+
+    // 透传分页信息
+    const headers: Record<string, string> = {};
+    for (const name of ['X-Total-Count', 'X-Next-Offset']) {
+      const value = response.headers.get(name);
+      if (value !== null) headers[name] = value;
+    }
+    return json(result, { headers });
   } catch (error) {
     console.error('获取聊天成员失败:', error);
     return json({ error: '聊天服务暂时不可用' }, { status: 500 });
@@ -19,11 +19,18 @@ export const POST: RequestHandler = async ({ request, fetch, cookies }) => {
     const controller = new AbortController();
     const timeoutId = setTimeout(() => controller.abort(), 15000); // 算命申请可能需要更长处理时间
     
+    // 透传幂等键，客户端重试时不会重复上传和创建申请
+    const headers: Record<string, string> = {
+      'Authorization': `Bearer ${token}`
+    };
+    const idempotencyKey = request.headers.get('Idempotency-Key');
+    if (idempotencyKey) {
+      headers['Idempotency-Key'] = idempotencyKey;
+    }
+    
     const response = await fetch(`${apiBaseUrl}/fortune/apply`, {
       method: 'POST',
-      headers: {
-        'Authorization': `Bearer ${token}`
-      },
+      headers,
       body: formData,
       signal: controller.signal
     });
@@ -36,7 +43,9 @@ export const POST: RequestHandler = async ({ request, fetch, cookies }) => {
     }
 
     const result = await response.json();
-    return json(result);
+    // 透传重放标记，客户端据此区分重试命中的缓存响应
+    const replayed = response.headers.get('Idempotent-Replayed');
+    return json(result, replayed ? { headers: { 'Idempotent-Replayed': replayed } } : undefined);
   } catch (error) {
     console.error('算命申请失败:', error);
     return json({ error: '算命服务暂时不可用' }, { status: 500 });